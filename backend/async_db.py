@@ -0,0 +1,33 @@
+"""Moteur SQLAlchemy asynchrone (asyncpg) des routes les plus sollicitées, et réglages des pools de connexions.
+
+Variables d'environnement (moteur synchrone et moteur async, chacun son pool) :
+DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT (s), DB_POOL_RECYCLE (s), DB_POOL_PRE_PING (1/0).
+"""
+import os
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+
+def env_flag(name, default):
+    return os.getenv(name, "1" if default else "0").strip().lower() not in ("0", "false", "no", "off", "")
+
+def pool_options():
+    # Défauts = ceux de SQLAlchemy. Chaque moteur (et chaque worker uvicorn) a son pool : rester sous max_connections.
+    # pool_pre_ping : un aller-retour de plus par emprunt, utile si le cloud coupe les connexions inactives
+    return {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "30")),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "300")),
+        "pool_pre_ping": env_flag("DB_POOL_PRE_PING", True),
+    }
+
+def async_url(database_url):
+    """URL psycopg2 -> (URL asyncpg, connect_args) : sslmode devient l'option ssl d'asyncpg."""
+    url = make_url(database_url).set(drivername="postgresql+asyncpg")
+    query = dict(url.query)
+    sslmode = query.pop("sslmode", None)
+    return url.set(query=query), ({"ssl": sslmode} if sslmode else {})
+
+def create_async_db_engine(database_url, **kwargs):
+    url, connect_args = async_url(database_url)
+    return create_async_engine(url, connect_args=connect_args, **pool_options(), **kwargs)
@@ -0,0 +1,52 @@
+import sys
+import time
+import tracemalloc
+import openpyxl
+from xlsx_stream import XlsxReader
+from importer import iter_parsed_sheets
+
+# Compare la lecture openpyxl (read_only) et le lecteur en flux xlsx_stream.
+# Usage : python bench_xlsx.py [catalogue.xlsx] [répétitions]
+
+def read_openpyxl(path):
+    wb = openpyxl.load_workbook(path, data_only=True, read_only=True)
+    try: return {name: list(wb[name].iter_rows(values_only=True)) for name in wb.sheetnames}
+    finally: wb.close()
+
+def read_stream(path):
+    with XlsxReader(path) as reader: return {name: list(reader.iter_rows(name)) for name in reader.sheetnames}
+
+def count_openpyxl(path):
+    wb = openpyxl.load_workbook(path, data_only=True, read_only=True)
+    try: return sum(1 for name in wb.sheetnames for _ in wb[name].iter_rows(values_only=True))
+    finally: wb.close()
+
+def count_stream(path):
+    with XlsxReader(path) as reader: return sum(1 for name in reader.sheetnames for _ in reader.iter_rows(name))
+
+def parse_stream(path):
+    return sum(len(sheet.rows) for sheet in iter_parsed_sheets(path, "upload", workers=1))
+
+def measure(label, fn, path, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter(); result = fn(path)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start(); fn(path); peak = tracemalloc.get_traced_memory()[1]; tracemalloc.stop()
+    print(f"   {label:<28} {best:7.3f} s   pic mémoire {peak / 1e6:7.1f} Mo   ({result} lignes)")
+    return best
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else "catalogue.xlsx"
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    print(f"🔍 Vérification : mêmes valeurs qu'openpyxl pour '{path}'...")
+    if read_openpyxl(path) != read_stream(path):
+        print("❌ Les deux lecteurs divergent !")
+        sys.exit(1)
+    print(f"⏱️  Lecture brute (meilleur de {repeat}) :")
+    t_ref = measure("openpyxl read_only", count_openpyxl, path, repeat)
+    t_new = measure("xlsx_stream", count_stream, path, repeat)
+    print(f"🚀 Accélération lecture : x{t_ref / t_new:.2f}")
+    print("⏱️  Import complet (lecture + nettoyage) :")
+    measure("xlsx_stream + importer", parse_stream, path, repeat)
@@ -0,0 +1,138 @@
+"""Chargement en masse via COPY ... FROM STDIN (upload HTTP et scripts d'import)."""
+import re
+from sqlalchemy import text
+
+# Ordre des colonnes du catalogue complet (main.py / upload-catalog)
+LENS_COLUMNS = (
+    "brand", "edi_code", "commercial_code", "name", "geometry", "design", "index_mat", "material", "coating",
+    "commercial_flow", "color", "purchase_price", "purchase_price_bonifie", "purchase_price_super_bonifie",
+    "selling_price", "sell_kalixia", "sell_itelis", "sell_carteblanche", "sell_seveane", "sell_santeclair"
+)
+
+# Format texte de COPY : tabulation entre colonnes, \N pour NULL, antislash comme échappement
+_COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+def _copy_value(value):
+    if value is None: return "\\N"
+    if isinstance(value, str): return value.translate(_COPY_ESCAPES)
+    return str(value)
+
+class _CopyStream:
+    """Fichier en lecture alimenté par un itérateur de tuples : le COPY part en flux, mémoire constante."""
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._buf = ""
+        self.count = 0
+
+    def read(self, size=-1):
+        lines, length = [self._buf], len(self._buf)
+        while self._rows is not None and (size < 0 or length < size):
+            try: row = next(self._rows)
+            except StopIteration: self._rows = None; break
+            line = "\t".join(map(_copy_value, row)) + "\n"
+            lines.append(line); length += len(line)
+            self.count += 1
+        data = "".join(lines)
+        if size < 0 or len(data) <= size: self._buf = ""; return data
+        self._buf = data[size:]
+        return data[:size]
+
+    readline = read
+
+def copy_rows(conn, table, columns, rows):
+    """Envoie rows (tuples dans l'ordre de columns) avec un seul COPY et renvoie le nombre de lignes.
+
+    conn est une Connection SQLAlchemy : le COPY s'exécute dans sa transaction courante.
+    """
+    stream = _CopyStream(rows)
+    cursor = conn.connection.cursor()
+    try: cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", stream, size=65536)
+    finally: cursor.close()
+    return stream.count
+
+# --- Table de préparation (remplacement du catalogue sans coupure) ---
+def _index_name(name, suffix):
+    return (name[:63 - len(suffix)] + suffix)
+
+def _secondary_indexes(conn, table):
+    # Index hors contraintes (la clé primaire est recréée à part)
+    return conn.execute(text("""
+        SELECT i.relname AS name, pg_get_indexdef(i.oid) AS definition
+        FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid
+        WHERE x.indrelid = CAST(:t AS regclass)
+          AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = x.indexrelid)
+    """), {"t": table}).fetchall()
+
+def create_staging_table(conn, table):
+    """(Re)crée {table}_staging vide, mêmes colonnes et valeurs par défaut, avec sa propre séquence d'id."""
+    staging = f"{table}_staging"
+    conn.execute(text(f"DROP TABLE IF EXISTS {staging}"))
+    conn.execute(text(f"CREATE TABLE {staging} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+    conn.execute(text(f"CREATE SEQUENCE {staging}_id_seq OWNED BY {staging}.id"))
+    conn.execute(text(f"ALTER TABLE {staging} ALTER COLUMN id SET DEFAULT nextval('{staging}_id_seq')"))
+    return staging
+
+def build_staging_indexes(conn, table):
+    """Crée sur la table de préparation la clé primaire et les index de la table en service (après chargement)."""
+    staging = f"{table}_staging"
+    conn.execute(text(f"ALTER TABLE {staging} ADD CONSTRAINT {staging}_pkey PRIMARY KEY (id)"))
+    for idx in _secondary_indexes(conn, table):
+        definition = re.sub(r"^CREATE (UNIQUE )?INDEX \S+ ON \S+ ", lambda m: f"CREATE {m.group(1) or ''}INDEX {_index_name(idx.name, '_stg')} ON {staging} ", idx.definition)
+        conn.execute(text(definition))
+    conn.execute(text(f"ANALYZE {staging}"))
+
+def swap_staging_table(conn, table):
+    """Met la table de préparation en service. Transaction courte : renommages + suppression de l'ancienne."""
+    staging = f"{table}_staging"
+    old_indexes = [idx.name for idx in _secondary_indexes(conn, table)]
+    conn.execute(text(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE"))
+    conn.execute(text(f"ALTER TABLE {table} RENAME TO {table}_old"))
+    conn.execute(text(f"ALTER TABLE {staging} RENAME TO {table}"))
+    conn.execute(text(f"DROP TABLE {table}_old"))
+    conn.execute(text(f"ALTER SEQUENCE {staging}_id_seq RENAME TO {table}_id_seq"))
+    conn.execute(text(f"ALTER TABLE {table} RENAME CONSTRAINT {staging}_pkey TO {table}_pkey"))
+    for name in old_indexes:
+        conn.execute(text(f"ALTER INDEX {_index_name(name, '_stg')} RENAME TO {name}"))
+
+def bump_catalog_version(conn):
+    """Nouvelle version du catalogue : les workers de l'API rechargent leur snapshot (et leurs ETag)."""
+    return conn.execute(text("UPDATE catalog_meta SET version = version + 1, updated_at = CURRENT_TIMESTAMP WHERE id = 1 RETURNING version")).scalar()
+
+def drop_staging_table(conn, table):
+    conn.execute(text(f"DROP TABLE IF EXISTS {table}_staging"))
+
+# --- Mise à jour différentielle (seules les lignes modifiées sont écrites) ---
+# Clé métier d'un verre : marque + code EDI (à défaut code commercial) + indice + traitement
+LENS_KEY_SQL = "concat_ws(chr(31), COALESCE(brand, ''), COALESCE(NULLIF(edi_code, ''), commercial_code, ''), COALESCE(index_mat, ''), COALESCE(coating, ''))"
+
+def upsert_from_staging(conn, table, columns, key_sql=LENS_KEY_SQL):
+    """Applique {table}_staging sur table : insère les nouvelles clés, met à jour les lignes dont
+    le hash de contenu a changé, supprime les clés disparues. Les id existants sont conservés.
+
+    Une clé présente plusieurs fois est appariée par rang d'apparition (ordre des id).
+    Renvoie {"inserted", "updated", "deleted", "unchanged"}.
+    """
+    staging = f"{table}_staging"
+    cols = ", ".join(columns)
+    row_hash = f"md5(ROW({cols})::text)"
+    conn.execute(text(f"""
+        CREATE TEMP TABLE {table}_diff ON COMMIT DROP AS
+        WITH cur AS (SELECT id, {key_sql} AS k, ROW_NUMBER() OVER (PARTITION BY {key_sql} ORDER BY id) AS n, {row_hash} AS h FROM {table}),
+             new AS (SELECT id, {key_sql} AS k, ROW_NUMBER() OVER (PARTITION BY {key_sql} ORDER BY id) AS n, {row_hash} AS h FROM {staging})
+        SELECT cur.id AS cur_id, new.id AS new_id, cur.h IS DISTINCT FROM new.h AS changed
+        FROM cur FULL JOIN new ON cur.k = new.k AND cur.n = new.n
+    """))
+    deleted = conn.execute(text(f"DELETE FROM {table} WHERE id IN (SELECT cur_id FROM {table}_diff WHERE new_id IS NULL)")).rowcount
+    updated = conn.execute(text(f"""
+        UPDATE {table} t SET ({cols}) = ({", ".join("s." + c for c in columns)})
+        FROM {table}_diff d JOIN {staging} s ON s.id = d.new_id
+        WHERE t.id = d.cur_id AND d.changed
+    """)).rowcount
+    inserted = conn.execute(text(f"""
+        INSERT INTO {table} ({cols})
+        SELECT {", ".join("s." + c for c in columns)} FROM {staging} s JOIN {table}_diff d ON d.new_id = s.id
+        WHERE d.cur_id IS NULL ORDER BY s.id
+    """)).rowcount
+    unchanged = conn.execute(text(f"SELECT COUNT(*) FROM {table}_diff WHERE cur_id IS NOT NULL AND new_id IS NOT NULL AND NOT changed")).scalar()
+    conn.execute(text(f"DROP TABLE {table}_diff"))
+    return {"inserted": inserted, "updated": updated, "deleted": deleted, "unchanged": unchanged}
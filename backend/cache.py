@@ -0,0 +1,54 @@
+"""Caches mémoire par processus (LRU + durée de vie), partagés entre threads."""
+import time
+import threading
+from collections import OrderedDict
+
+class TTLCache:
+    """LRU de size entrées valables ttl secondes. size <= 0 : cache désactivé (get renvoie toujours default).
+
+    Avec weigh (valeur -> poids, par ex. len pour des octets), size borne la somme des poids au lieu
+    du nombre d'entrées ; une valeur plus lourde que size à elle seule n'est pas gardée.
+    """
+
+    def __init__(self, size, ttl, weigh=None):
+        self.size, self.ttl = size, ttl
+        self._weigh = weigh or (lambda value: 1)
+        self._data = OrderedDict()
+        self._weight = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        if self.size <= 0: return default
+        with self._lock:
+            hit = self._data.get(key)
+            if hit is None: return default
+            if hit[0] <= time.monotonic():
+                self._drop(key)
+                return default
+            self._data.move_to_end(key)
+            return hit[1]
+
+    def put(self, key, value):
+        if self.size <= 0: return value
+        weight = self._weigh(value)
+        with self._lock:
+            self._drop(key)
+            if weight > self.size: return value
+            self._data[key] = (time.monotonic() + self.ttl, value, weight)
+            self._weight += weight
+            while self._weight > self.size: self._drop(next(iter(self._data)))
+        return value
+
+    def pop(self, key):
+        with self._lock: self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._weight = 0
+
+    def _drop(self, key):
+        hit = self._data.pop(key, None)
+        if hit is not None: self._weight -= hit[2]
+
+    def __len__(self): return len(self._data)
@@ -0,0 +1,69 @@
+import os
+import sys
+import json
+from datetime import datetime
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, text
+
+# Vérifie par EXPLAIN que chaque requête des routes chaudes peut être servie par son index
+# (parcours séquentiels désactivés : on teste les prédicats, pas les volumes de la base de test).
+# Usage : python explain_check.py [identifiant]   (DATABASE_URL comme pour l'API)
+
+def checks(username):
+    now, big_id = datetime.now(), 2**31 - 1
+    return [
+        # (route, requête, paramètres, index attendu, tri évité)
+        ("login", "SELECT username, password FROM users WHERE LOWER(username) = LOWER(:u)", {"u": username}, "idx_users_lower_username", False),
+        ("fiche utilisateur", "SELECT settings FROM users WHERE username = :u", {"u": username}, "users_pkey", False),
+        ("/offers", "SELECT id FROM client_offers WHERE username = :u ORDER BY created_at DESC, id DESC LIMIT 51",
+         {"u": username}, "idx_offers_user_created", True),
+        ("/offers curseur", "SELECT id FROM client_offers WHERE (created_at, id) < (:c_at, :c_id) AND username = :u ORDER BY created_at DESC, id DESC LIMIT 51",
+         {"u": username, "c_at": now, "c_id": big_id}, "idx_offers_user_created", True),
+        ("/offers période", "SELECT id FROM client_offers WHERE created_at >= :d AND username = :u ORDER BY created_at DESC, id DESC LIMIT 51",
+         {"u": username, "d": datetime(now.year, 1, 1)}, "idx_offers_user_created", True),
+        ("/offers géométrie", "SELECT id FROM client_offers WHERE tags->>'geometry' = :g AND username = :u ORDER BY created_at DESC, id DESC LIMIT 51",
+         {"u": username, "g": "PROGRESSIF"}, "idx_offers_user_created", True),
+        ("/offers admin", "SELECT id FROM client_offers ORDER BY created_at DESC, id DESC LIMIT 51", {}, "idx_offers_created", True),
+        ("/offers/identities", "SELECT id, encrypted_identity FROM client_offers WHERE id = ANY(:ids)", {"ids": [1, 2, 3]}, "client_offers_pkey", False),
+        ("/admin/stats", "SELECT category, value, SUM(volume) FROM offer_stats_rollup WHERE username = :u GROUP BY category, value",
+         {"u": username}, "offer_stats_rollup_pkey", False),
+        ("/admin/stats tops", "SELECT geometry, design, SUM(volume) FROM offer_top_rollup WHERE username = :u GROUP BY geometry, design",
+         {"u": username}, "offer_top_rollup_pkey", False),
+    ]
+
+def plan_nodes(node):
+    yield node
+    for child in node.get("Plans", []): yield from plan_nodes(child)
+
+def explain(conn, sql, params):
+    plan = conn.execute(text(f"EXPLAIN (FORMAT JSON) {sql}"), params).scalar()
+    if isinstance(plan, str): plan = json.loads(plan)
+    return list(plan_nodes(plan[0]["Plan"]))
+
+def run(engine, username):
+    failures = 0
+    with engine.connect() as conn:
+        trx = conn.begin()
+        conn.execute(text("SET LOCAL enable_seqscan = off"))
+        items = checks(username)
+        if conn.execute(text("SELECT EXISTS (SELECT 1 FROM pg_indexes WHERE indexname = 'idx_lenses_search_trgm')")).scalar():
+            from search import SEARCH_SQL
+            items.append(("/lenses/search", SEARCH_SQL.format(brand_filter=""), {"q": "VARILUX", "limit": 20}, "idx_lenses_search_trgm", False))
+        else: print("ℹ️  /lenses/search : pas d'index pg_trgm (recherche en mémoire)")
+        for route, sql, params, index, no_sort in items:
+            nodes = explain(conn, sql, params)
+            used = {n["Index Name"] for n in nodes if "Index Name" in n}
+            sorted_ = any(n["Node Type"] in ("Sort", "Incremental Sort") for n in nodes)
+            ok = index in used and not (no_sort and sorted_)
+            failures += not ok
+            detail = ", ".join(sorted(used)) or "aucun index"
+            print(f"{'✅' if ok else '❌'} {route:<20} {detail}{' + tri' if sorted_ else ''}")
+        trx.rollback()
+    return failures
+
+if __name__ == "__main__":
+    load_dotenv()
+    url = os.getenv("DATABASE_URL")
+    if not url: sys.exit("DATABASE_URL manquant")
+    if url.startswith("postgres://"): url = url.replace("postgres://", "postgresql://", 1)
+    sys.exit(1 if run(create_engine(url), sys.argv[1] if len(sys.argv) > 1 else "admin") else 0)
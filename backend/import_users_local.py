@@ -1,9 +1,10 @@
 import os
 import sys
-import time
 from sqlalchemy import create_engine, text
 from dotenv import load_dotenv
-import openpyxl
+from xlsx_stream import XlsxReader
+from importer import iter_user_rows, USER_UPSERT
+from migrations import LATEST_VERSION, schema_version, migrate
 
 # 1. Chargement Configuration
 load_dotenv()
@@ -39,10 +40,7 @@ def import_users():
     print(f"🚀 Démarrage import UTILISATEURS depuis '{excel_file}'...")
     
     try:
-        wb = openpyxl.load_workbook(excel_file, data_only=True)
-        sheet = wb.active
-        
-        # Récupération des données (On saute la ligne 1 d'en-tête)
+        # Récupération des données
         users_to_insert = []
         seen_ids = set() # Pour traquer les doublons
         row_count = 0
@@ -50,45 +48,18 @@ def import_users():
         
         print("📖 Lecture du fichier Excel...")
         
-        for row in sheet.iter_rows(min_row=2, values_only=True):
-            # Colonne A (Index 0) : Identifiant (Obligatoire)
-            if not row[0]: 
-                continue
-            
-            u_id = str(row[0]).strip()
-
-            # VÉRIFICATION DOUBLONS
-            if u_id in seen_ids:
-                # print(f"   ⚠️ Doublon ignoré : {u_id}") # Décommentez pour voir le détail
-                duplicates_count += 1
-                continue
-            
-            seen_ids.add(u_id)
-            
-            # Colonne B (Index 1) : Magasin / Raison Sociale
-            u_shop = str(row[1]).strip() if len(row) > 1 and row[1] else "Opticien"
-            
-            # Colonne C (Index 2) : Mot de passe
-            u_pass = str(row[2]).strip() if len(row) > 2 and row[2] else "1234"
-            
-            # Colonne D (Index 3) : Email
-            u_mail = str(row[3]).strip() if len(row) > 3 and row[3] else ""
-            
-            # Colonne E (Index 4) : Rôle (admin/user)
-            u_role = "user"
-            if len(row) > 4 and row[4]:
-                val = str(row[4]).lower().strip()
-                if "admin" in val:
-                    u_role = "admin"
-
-            users_to_insert.append({
-                "u": u_id,
-                "s": u_shop,
-                "p": u_pass,
-                "e": u_mail,
-                "r": u_role
-            })
-            row_count += 1
+        # En-tête et colonnes repérés par leur intitulé (importer.py, comme l'upload admin)
+        with XlsxReader(excel_file) as wb:
+            for user in iter_user_rows(wb.iter_rows(wb.active)):
+                # VÉRIFICATION DOUBLONS
+                if user["u"] in seen_ids:
+                    # print(f"   ⚠️ Doublon ignoré : {user['u']}") # Décommentez pour voir le détail
+                    duplicates_count += 1
+                    continue
+                
+                seen_ids.add(user["u"])
+                users_to_insert.append(user)
+                row_count += 1
 
         print(f"✅ {len(users_to_insert)} utilisateurs uniques lus ({duplicates_count} doublons ignorés).")
 
@@ -96,32 +67,19 @@ def import_users():
             print("⚠️ Aucun utilisateur trouvé à insérer.")
             return
 
-        # Insertion en base
+        # Schéma géré par migrations.py : la table users (settings, index) n'est jamais redéfinie ici
+        with engine.connect() as conn: version = schema_version(conn)
+        if version < LATEST_VERSION: migrate(engine)
+
+        # Insertion en base (même upsert que /upload-users)
         with engine.begin() as conn:
-            print("♻️  Recréation de la table 'users' (Mise à jour structure)...")
-            conn.execute(text("DROP TABLE IF EXISTS users CASCADE;"))
-            
-            conn.execute(text("""
-                CREATE TABLE users (
-                    username VARCHAR(100) PRIMARY KEY,
-                    shop_name TEXT,
-                    password TEXT,
-                    email TEXT,
-                    role VARCHAR(50) DEFAULT 'user',
-                    is_first_login BOOLEAN DEFAULT TRUE
-                );
-            """))
-            
-            print(f"💾 Insertion de {len(users_to_insert)} comptes...")
-            conn.execute(text("""
-                INSERT INTO users (username, shop_name, password, email, role, is_first_login)
-                VALUES (:u, :s, :p, :e, :r, TRUE)
-            """), users_to_insert)
+            print(f"💾 Import de {len(users_to_insert)} comptes...")
+            conn.execute(text(USER_UPSERT), users_to_insert)
             
         print("\n🎉 SUCCÈS ! Base utilisateurs mise à jour.")
-        print(f"   -> {len(users_to_insert)} comptes créés.")
-        print("   -> Mot de passe par défaut: '1234' (ou celui de la colonne C)")
-        print("   -> Rôle Admin appliqué si colonne E contient 'admin'")
+        print(f"   -> {len(users_to_insert)} comptes créés ou mis à jour.")
+        print("   -> Nouveaux comptes : mot de passe par défaut '1234' (ou celui de la colonne mot de passe)")
+        print("   -> Rôle Admin appliqué si la colonne rôle contient 'admin'")
 
     except Exception as e:
         print(f"\n❌ ERREUR CRITIQUE : {e}")
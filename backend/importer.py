@@ -0,0 +1,388 @@
+"""Import des classeurs (catalogue, utilisateurs) : nettoyage, mapping des en-têtes et analyse des feuilles.
+
+Les en-têtes d'une feuille sont résolus une seule fois en une fonction de transformation
+(indices, nettoyeurs et valeurs par défaut figés) appliquée ensuite à chaque ligne.
+Les règles propres à chaque point d'entrée (upload HTTP, scripts) sont décrites par un CatalogProfile.
+"""
+import os
+import re
+import shutil
+import tempfile
+import multiprocessing
+from collections import namedtuple
+from operator import itemgetter
+from itertools import islice, chain
+from concurrent.futures import ProcessPoolExecutor
+from bulk_load import LENS_COLUMNS
+from xlsx_stream import XlsxReader, open_workbook
+
+# Nombre de processus d'analyse des gros classeurs (0 = défaut : 4 au plus, pour ne pas affamer les workers de l'API).
+# 1 = toujours analyser dans le processus courant.
+IMPORT_WORKERS = int(os.getenv("IMPORT_WORKERS", "0")) or min(4, os.cpu_count() or 1)
+# Pool seulement au-delà de ce volume de XML de feuilles : l'analyse en ligne tourne à ~6,5 Mo/s, alors qu'un
+# processus "spawn" met ~0,6 s à démarrer. Le catalogue actuel (~3,8 Mo) : 0,59 s en ligne, 1,93 s / 2,97 s avec 2 / 4 processus.
+IMPORT_PARALLEL_MIN_BYTES = int(os.getenv("IMPORT_PARALLEL_MIN_BYTES", str(32 * 1024 * 1024)))
+
+# --- NETTOYAGE (tables et regex précompilées) ---
+_PRICE_TABLE = str.maketrans({'€': None, '%': None, ' ': None, '\xa0': None, ',': '.'})
+ACCENTED, UNACCENTED = 'ÉÈÊËÀÂÎÏÔÙÇ', 'EEEEAAIIOUC'
+_ACCENT_TABLE = str.maketrans(ACCENTED, UNACCENTED)
+_INDEX_RE = re.compile(r"\d+\.?\d*")
+_index_cache = {}
+
+def clean_price(value):
+    if not value or value == '-': return 0.0
+    if value.__class__ is float or value.__class__ is int: return float(value)
+    s = str(value)
+    if 'â' in s: s = s.replace('€', '').replace('â‚¬', '') # euro mal décodé (UTF-8 lu en cp1252)
+    try: return float(s.translate(_PRICE_TABLE))
+    except ValueError: return 0.0
+
+def clean_index(value):
+    if not value or value is True: return "1.50"
+    # Quelques dizaines d'indices distincts pour des milliers de lignes
+    cached = _index_cache.get(value)
+    if cached is None:
+        match = _INDEX_RE.search(str(value).replace(',', '.'))
+        cached = "{:.2f}".format(float(match.group(0))) if match else "1.50"
+        if len(_index_cache) < 4096: _index_cache[value] = cached
+    return cached
+
+def clean_text(value): return str(value).strip() if value else ""
+
+def normalize_string(text):
+    if not text: return ""
+    return str(text).upper().strip().translate(_ACCENT_TABLE)
+
+def get_col_idx(headers, candidates):
+    candidates = [normalize_string(c) for c in candidates]
+    for i, h in enumerate(headers):
+        if h:
+            h_str = normalize_string(h)
+            for c in candidates:
+                if c in h_str: return i
+    return -1
+
+def find_header(rows, keywords, max_rows):
+    """Cherche l'en-tête dans les max_rows premières lignes de l'itérateur rows.
+
+    Renvoie (numéro de ligne 1-based, en-tête) ou (-1, None) ; rows est consommé jusqu'à l'en-tête.
+    """
+    for number, row in enumerate(rows, 1):
+        if number > max_rows: break
+        row_str = [str(c).upper() for c in row if c]
+        if any(k in s for s in row_str for k in keywords): return number, row
+    return -1, None
+
+# --- MAPPING COMPILÉ ---
+class ColumnMap:
+    """Colonnes d'une feuille résolues une fois : {champ: candidats} -> indices + extracteur par tuple."""
+
+    def __init__(self, headers, fields):
+        self.index = {field: get_col_idx(headers, candidates) for field, candidates in fields.items()}
+        self.present = [field for field, idx in self.index.items() if idx != -1]
+        positions = [self.index[f] for f in self.present]
+        self.width = max(positions, default=-1) + 1
+        self._pad = (None,) * self.width
+        if len(positions) == 1:
+            only = positions[0]
+            self._extract = lambda row: (row[only],) # itemgetter à un seul indice ne renvoie pas de tuple
+        else: self._extract = itemgetter(*positions)
+
+    def __contains__(self, field): return self.index.get(field, -1) != -1
+
+    def values(self, row):
+        """Valeurs brutes des colonnes présentes, dans l'ordre de self.present (lignes courtes complétées)."""
+        if len(row) < self.width: row = tuple(row) + self._pad[len(row):]
+        return self._extract(row)
+
+# --- PROFILS CATALOGUE ---
+PRICE_COLUMNS = {"purchase_price", "purchase_price_bonifie", "purchase_price_super_bonifie", "selling_price",
+                 "sell_kalixia", "sell_itelis", "sell_carteblanche", "sell_seveane", "sell_santeclair"}
+# Colonnes des tables créées par les scripts (sans les prix bonifiés)
+IMPORT_COLUMNS = tuple(c for c in LENS_COLUMNS if c not in ("purchase_price_bonifie", "purchase_price_super_bonifie"))
+
+class CatalogProfile:
+    """Règles d'import d'un classeur catalogue.
+
+    columns : {colonne lenses: candidats d'en-tête} ; selling_price reprend la colonne sell_kalixia.
+    defaults : valeur d'une colonne absente de la feuille (sinon "" / 0 / "1.50").
+    geometry_rules : [(mots du champ géométrie, type)], première règle qui correspond, sinon UNIFOCAL.
+    geometry_overrides : [(mot, type)] cherchés dans nom + design + code commercial, appliqués dans l'ordre.
+    """
+
+    def __init__(self, columns, output=LENS_COLUMNS, defaults=None, header_keywords=("MODELE", "LIBELLE", "NAME"),
+                 header_rows=30, name_materials=(), geometry_rules=(), geometry_overrides=(),
+                 purchase_fallback=False, skip_unpriced=False):
+        self.columns, self.output, self.defaults = columns, output, defaults or {}
+        self.header_keywords, self.header_rows = header_keywords, header_rows
+        self.name_materials, self.geometry_rules, self.geometry_overrides = name_materials, geometry_rules, geometry_overrides
+        self.purchase_fallback = purchase_fallback # prix d'achat <= 0 : prix Kalixia, sinon 0.01
+        self.skip_unpriced = skip_unpriced # ligne ignorée si la colonne prix d'achat existe et vaut 0
+
+    def default(self, column):
+        if column in self.defaults: return self.defaults[column]
+        if column in PRICE_COLUMNS: return 0
+        return "1.50" if column == "index_mat" else ""
+
+    def classify(self, geo_raw):
+        for words, ltype in self.geometry_rules:
+            if any(w in geo_raw for w in words): return ltype
+        return 'UNIFOCAL'
+
+    def compile(self, headers, sheet_brand):
+        """Fonction ligne -> tuple (ordre self.output) ou None, pour une feuille d'en-tête headers.
+
+        Renvoie None si la colonne modèle est introuvable. transform.columns = indices résolus.
+        """
+        cmap = ColumnMap(headers, self.columns)
+        if "name" not in cmap: return None
+        out_pos = {c: i for i, c in enumerate(self.output)}
+        # Gabarit : les colonnes absentes gardent leur défaut, les présentes ont leur nettoyeur figé
+        template = [self.default(c) for c in self.output]
+        simple = []
+        for i, field in enumerate(cmap.present):
+            if field in ("brand", "geometry"): continue # calculés ligne par ligne
+            cleaner = clean_price if field in PRICE_COLUMNS else clean_index if field == "index_mat" else clean_text
+            for column in ((field, "selling_price") if field == "sell_kalixia" else (field,)):
+                if column in out_pos: simple.append((i, out_pos[column], cleaner))
+        at = cmap.present.index
+        i_name = at("name")
+        i_brand = at("brand") if "brand" in cmap else None
+        i_geo = at("geometry") if "geometry" in cmap else None
+        i_kal = at("sell_kalixia") if "sell_kalixia" in cmap else None
+        p_brand, p_name, p_geo = out_pos["brand"], out_pos["name"], out_pos["geometry"]
+        p_design, p_code, p_mat, p_buy = out_pos["design"], out_pos["commercial_code"], out_pos["material"], out_pos["purchase_price"]
+        materials, overrides, classify = self.name_materials, self.geometry_overrides, self.classify
+        purchase_fallback = self.purchase_fallback
+        skip_unpriced = self.skip_unpriced and "purchase_price" in cmap
+        values = cmap.values
+
+        def transform(row):
+            raw = values(row)
+            if not raw[i_name]: return None
+            out = template[:]
+            for i, pos, cleaner in simple: out[pos] = cleaner(raw[i])
+            if skip_unpriced and out[p_buy] == 0: return None
+            brand = clean_text(raw[i_brand]) if i_brand is not None else sheet_brand
+            if not brand or brand == "None": brand = sheet_brand
+            out[p_brand] = brand[:100]
+            name, mat = out[p_name], out[p_mat]
+            if materials and any(x in mat.upper() for x in materials): name += f" {mat}"; out[p_name] = name
+            ltype = classify(clean_text(raw[i_geo]).upper() if i_geo is not None else "")
+            if overrides:
+                full_search = (name + " " + out[p_design] + " " + out[p_code]).upper().replace(" ", "")
+                for word, forced in overrides:
+                    if word in full_search: ltype = forced
+            out[p_geo] = ltype
+            if purchase_fallback and out[p_buy] <= 0: out[p_buy] = clean_price(raw[i_kal]) if i_kal is not None else 0.01
+            return tuple(out)
+        transform.columns = cmap.index
+        return transform
+
+# Upload HTTP (main.py) : toutes les colonnes, règles de géométrie complètes
+UPLOAD_PROFILE = CatalogProfile(
+    columns={
+        "name": ['MODELE COMMERCIAL', 'MODELE', 'LIBELLE', 'NAME'],
+        "brand": ['MARQUE', 'BRAND'],
+        "edi_code": ['CODE EDI', 'EDI'],
+        "commercial_code": ['CODE COMMERCIAL', 'COMMERCIAL_CODE'],
+        "geometry": ['GÉOMETRIE', 'GEOMETRIE', 'TYPE'],
+        "design": ['DESIGN', 'GAMME'],
+        "index_mat": ['INDICE', 'INDEX'],
+        "material": ['MATIERE', 'MATIÈRE', 'MATERIAL'],
+        "coating": ['TRAITEMENT', 'COATING'],
+        "commercial_flow": ['FLUX', 'COMMERCIAL_FLOW'],
+        "color": ['COULEUR', 'COLOR'],
+        "purchase_price": ['PRIX 2*NETS', 'PRIX', 'ACHAT', 'PURCHASE_PRICE'],
+        "purchase_price_bonifie": ['PRIX BONIFIE', 'ACHAT BONIFIE', 'BONIFIE'],
+        "purchase_price_super_bonifie": ['PRIX SUPER BONIFIE', 'SUPER BONIFIE', 'SUPER'],
+        "sell_kalixia": ['KALIXIA'],
+        "sell_itelis": ['ITELIS'],
+        "sell_carteblanche": ['CARTE BLANCHE'],
+        "sell_seveane": ['SEVEANE'],
+        "sell_santeclair": ['SANTECLAIR'],
+    },
+    defaults={"design": "STANDARD", "coating": "DURCI", "commercial_flow": "FAB"},
+    name_materials=('TRANS', 'GEN', 'SOLA', 'SUN'),
+    geometry_rules=((('DEGRESSIF',), 'DEGRESSIF'), (('INTERIEUR',), 'PROGRESSIF_INTERIEUR'), (('PROG',), 'PROGRESSIF'), (('MULTIFOCAL',), 'MULTIFOCAL')),
+    geometry_overrides=(('PROXEO', 'DEGRESSIF'), ('MYPROXI', 'PROGRESSIF_INTERIEUR')),
+    purchase_fallback=True,
+)
+
+# import_local.py : diagnostic, on importe tout (même sans prix)
+LOCAL_PROFILE = CatalogProfile(
+    columns={
+        "name": ['MODELE COMMERCIAL', 'MODELE', 'LIBELLE', 'NAME'],
+        "purchase_price": ['PRIX 2*NETS', 'PRIX', 'ACHAT', 'PURCHASE_PRICE'],
+        "brand": ['MARQUE', 'BRAND'],
+        "edi_code": ['CODE EDI', 'EDI', 'EDI_CODE'],
+        "commercial_code": ['CODE COMMERCIAL', 'COMMERCIAL_CODE'],
+        "geometry": ['GÉOMETRIE', 'GEOMETRIE', 'TYPE', 'GEOMETRY'],
+        "design": ['DESIGN', 'GAMME'],
+        "index_mat": ['INDICE', 'INDEX', 'INDEX_MAT'],
+        "material": ['MATIERE', 'MATIÈRE', 'MATERIAL'],
+        "coating": ['TRAITEMENT', 'COATING'],
+        "commercial_flow": ['FLUX', 'COMMERCIAL_FLOW'],
+        "color": ['COULEUR', 'COLOR'],
+        "sell_kalixia": ['KALIXIA', 'SELL_KALIXIA'],
+        "sell_itelis": ['ITELIS', 'SELL_ITELIS'],
+        "sell_carteblanche": ['CARTE BLANCHE', 'SELL_CARTEBLANCHE'],
+        "sell_seveane": ['SEVEANE', 'SELL_SEVEANE'],
+        "sell_santeclair": ['SANTECLAIRE', 'SANTECLAIR', 'SELL_SANTECLAIR'],
+    },
+    output=IMPORT_COLUMNS,
+    header_keywords=("MODELE", "MODÈLE", "LIBELLE", "NAME", "PRIX"),
+    name_materials=('TRANS', 'GEN', 'SOLA'),
+    geometry_rules=((('PROG',), 'PROGRESSIF'), (('DEGRESSIF',), 'DEGRESSIF'), (('MULTIFOCAL',), 'MULTIFOCAL')),
+)
+
+# import_sheets.py : lignes sans prix d'achat ignorées
+SHEETS_PROFILE = CatalogProfile(
+    columns={
+        "brand": ['MARQUE', 'FABRICANT', 'BRAND'],
+        "name": ['MODELE COMMERCIAL', 'MODELE', 'LIBELLE', 'NAME'],
+        "purchase_price": ['PRIX 2*NETS', '2*NETS', 'ACHAT', 'PURCHASE_PRICE'],
+        "edi_code": ['CODE EDI', 'EDI_CODE'],
+        "commercial_code": ['CODE COMMERCIAL', 'COMMERCIAL_CODE'],
+        "geometry": ['GÉOMETRIE', 'GEOMETRIE', 'TYPE', 'GEOMETRY'],
+        "design": ['DESIGN', 'GAMME'],
+        "index_mat": ['INDICE', 'INDEX_MAT'],
+        "material": ['MATIERE', 'MATERIAL'],
+        "coating": ['TRAITEMENT', 'COATING'],
+        "commercial_flow": ['FLUX COMMERCIAL', 'FLUX', 'COMMERCIAL_FLOW'],
+        "color": ['COULEUR', 'COLOR'],
+        "sell_kalixia": ['KALIXIA', 'SELL_KALIXIA'],
+        "sell_itelis": ['ITELIS', 'SELL_ITELIS'],
+        "sell_carteblanche": ['CARTE BLANCHE', 'SELL_CARTEBLANCHE'],
+        "sell_seveane": ['SEVEANE', 'SELL_SEVEANE'],
+        "sell_santeclair": ['SANTECLAIRE', 'SANTECLAIR', 'SELL_SANTECLAIR'],
+    },
+    output=IMPORT_COLUMNS,
+    defaults={"design": "STANDARD", "coating": "DURCI", "commercial_flow": "FAB"},
+    header_keywords=("MODELE", "MARQUE", "BRAND", "NAME", "GEOMETRY"),
+    header_rows=10,
+    geometry_rules=((('PROG',), 'PROGRESSIF'), (('DEGRESSIF', 'INTERIEUR'), 'DEGRESSIF'), (('MULTIFOCAL',), 'MULTIFOCAL')),
+    skip_unpriced=True,
+)
+
+PROFILES = {"upload": UPLOAD_PROFILE, "local": LOCAL_PROFILE, "sheets": SHEETS_PROFILE}
+
+# --- ANALYSE D'UNE FEUILLE (exécutée dans un processus du pool) ---
+ParsedSheet = namedtuple("ParsedSheet", "brand header_row columns read rows")
+
+def parse_sheet(source, sheet_name, profile="upload"):
+    """Lignes nettoyées d'une feuille, dans l'ordre de PROFILES[profile].output.
+
+    Renvoie un ParsedSheet, ou None si la feuille n'a pas d'en-tête ou de colonne modèle.
+    """
+    profile = PROFILES[profile]
+    with open_workbook(source) as wb:
+        sheet_brand = sheet_name.strip().upper()
+        row_iterator = wb.iter_rows(sheet_name)
+        header_row, headers = find_header(row_iterator, profile.header_keywords, profile.header_rows)
+        if headers is None: return None
+        transform = profile.compile(headers, sheet_brand)
+        if transform is None: return None
+        read, rows = 0, []
+        for row in row_iterator:
+            read += 1
+            cleaned = transform(row)
+            if cleaned is not None: rows.append(cleaned)
+        return ParsedSheet(sheet_brand, header_row, transform.columns, read, rows)
+
+# --- RÉPARTITION DES FEUILLES ---
+def iter_parsed_sheets(source, profile="upload", workers=None, mp_context="spawn"):
+    """Analyse chaque feuille de source (chemin ou fichier binaire seekable) avec le profil donné.
+
+    En ligne par défaut ; pool de IMPORT_WORKERS processus si le XML des feuilles dépasse
+    IMPORT_PARALLEL_MIN_BYTES (ou si workers est imposé).
+
+    Les résultats sont rendus dans l'ordre du classeur (ids et ordre d'insertion identiques à
+    une lecture séquentielle) dès que la feuille concernée est prête ; les feuilles ignorées
+    sont sautées. "spawn" par défaut : le serveur a des threads actifs, on ne fork pas.
+    Un fichier ouvert n'est recopié sur disque que si le pool est utilisé (les processus ouvrent un chemin).
+    """
+    with XlsxReader(source) as reader:
+        names = reader.sheetnames
+        if workers is None: workers = IMPORT_WORKERS if sum(map(reader.sheet_size, names)) >= IMPORT_PARALLEL_MIN_BYTES else 1
+        workers = min(workers, len(names))
+        if workers <= 1:
+            # Sans pool : un seul lecteur, chaînes partagées décodées une fois
+            for name in names:
+                result = parse_sheet(reader, name, profile)
+                if result is not None: yield result
+            return
+    scratch = None
+    if not isinstance(source, (str, os.PathLike)):
+        fd, scratch = tempfile.mkstemp(prefix="catalog_", suffix=".xlsx")
+        with os.fdopen(fd, "wb") as buffer:
+            source.seek(0); shutil.copyfileobj(source, buffer, 1024 * 1024)
+    path = scratch or source
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(mp_context)) as pool:
+            futures = [pool.submit(parse_sheet, path, name, profile) for name in names]
+            try:
+                for future in futures:
+                    result = future.result()
+                    if result is not None: yield result
+            finally:
+                for future in futures: future.cancel()
+    finally:
+        if scratch: os.remove(scratch)
+
+# --- UTILISATEURS ---
+USER_COLUMNS = {
+    "username": ['IDENTIFIANT', 'ID', 'USERNAME', 'LOGIN'],
+    "shop_name": ['MAGASIN', 'SHOP', 'RAISON SOCIALE', 'NOM'],
+    "password": ['PASSWORD', 'MOT DE PASSE', 'MDP'],
+    "email": ['MAIL', 'EMAIL', 'COURRIEL'],
+    "role": ['ROLE', 'TYPE', 'DROIT'],
+}
+USER_HEADER_KEYWORDS = ("IDENTIFIANT", "USERNAME", "LOGIN", "ID CLIENT")
+
+def compile_user_transform(headers):
+    """Fonction ligne -> {"u", "s", "p", "e", "r"} (paramètres de l'upsert users) ou None. ValueError sans colonne identifiant."""
+    cmap = ColumnMap(headers, USER_COLUMNS)
+    if "username" not in cmap: raise ValueError("Colonne Identifiant manquante")
+    at = cmap.present.index
+    i_id = at("username")
+    i_shop, i_pass, i_mail, i_role = (at(f) if f in cmap else None for f in ("shop_name", "password", "email", "role"))
+    values = cmap.values
+
+    def transform(row):
+        raw = values(row)
+        if not raw[i_id]: return None
+        role = "user"
+        if i_role is not None and raw[i_role] and "admin" in str(raw[i_role]).lower().strip(): role = "admin"
+        return {
+            "u": str(raw[i_id]).strip(),
+            "s": str(raw[i_shop]).strip() if i_shop is not None and raw[i_shop] else "Opticien",
+            "p": str(raw[i_pass]).strip() if i_pass is not None and raw[i_pass] else "1234",
+            "e": str(raw[i_mail]).strip() if i_mail is not None and raw[i_mail] else "",
+            "r": role,
+        }
+    return transform
+
+def iter_user_rows(rows, header_rows=20):
+    """Utilisateurs {"u", "s", "p", "e", "r"} des lignes d'une feuille ; en-tête cherché dans les header_rows
+    premières lignes (à défaut la première). ValueError si la feuille est vide ou sans colonne identifiant."""
+    rows = iter(rows)
+    head = list(islice(rows, header_rows))
+    if not head: raise ValueError("Fichier vide")
+    header_row, headers = find_header(iter(head), USER_HEADER_KEYWORDS, header_rows)
+    if headers is None: header_row, headers = 1, head[0]
+    transform = compile_user_transform(headers)
+    for row in chain(head[header_row:], rows):
+        user = transform(row)
+        if user is not None: yield user
+
+# Upsert des comptes (/upload-users et import_users_local.py) : mot de passe, réglages et premier login des comptes existants conservés
+USER_UPSERT = """
+    INSERT INTO users (username, shop_name, password, email, role, is_first_login)
+    VALUES (:u, :s, :p, :e, :r, TRUE)
+    ON CONFLICT (username) DO UPDATE SET
+        shop_name = EXCLUDED.shop_name,
+        email = EXCLUDED.email,
+        role = EXCLUDED.role;
+"""
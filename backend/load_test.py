@@ -0,0 +1,61 @@
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+import httpx
+
+# Test de charge des routes chaudes (ouverture des magasins : login, catalogue, historique, stats).
+# Usage : python load_test.py http://localhost:8000 --users admin --password admin -c 50 -d 20
+# (serveur lancé à part, par ex. uvicorn main:app --workers 1)
+# Dépendance en plus de requirements.txt (outil de dev, pas installé en production) : pip install httpx
+
+def scenario(user, password, lens_limit=3000):
+    """Requêtes d'un opticien qui se connecte : (nom, méthode, chemin, paramètres, corps JSON)."""
+    return [
+        ("login", "POST", "/auth/login", None, {"username": user, "password": password}),
+        ("lenses", "GET", "/lenses", {"limit": lens_limit}, None),
+        ("offers", "GET", "/offers", {"username": user, "fields": "summary", "identity": "handle", "limit": 50}, None),
+        ("stats", "GET", "/admin/stats", {"username": user}, None),
+    ]
+
+async def worker(client, steps, deadline, timings, errors):
+    while time.perf_counter() < deadline:
+        for name, method, path, params, body in steps:
+            start = time.perf_counter()
+            try:
+                r = await client.request(method, path, params=params, json=body)
+                if r.status_code >= 400: errors[name] = errors.get(name, 0) + 1
+            except httpx.HTTPError: errors[name] = errors.get(name, 0) + 1
+            timings.setdefault(name, []).append(time.perf_counter() - start)
+
+def percentile(values, p): return values[min(len(values) - 1, int(len(values) * p))]
+
+async def run(args):
+    users = args.users.split(",")
+    timings, errors = {}, {}
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=60) as client:
+        for name, method, path, params, body in scenario(users[0], args.password, args.lens_limit):
+            await client.request(method, path, params=params, json=body) # préchauffage (snapshot catalogue...)
+        deadline = time.perf_counter() + args.duration
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client, scenario(users[i % len(users)], args.password, args.lens_limit), deadline, timings, errors) for i in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+    total = sum(len(v) for v in timings.values())
+    print(f"⏱️  {args.concurrency} clients, {elapsed:.1f} s : {total} requêtes, {total / elapsed:.0f} req/s")
+    for name, values in timings.items():
+        values.sort()
+        print(f"   {name:<8} {len(values):6d} req  {len(values) / elapsed:7.0f} req/s   p50 {statistics.median(values) * 1000:7.1f} ms"
+              f"   p95 {percentile(values, 0.95) * 1000:7.1f} ms   p99 {percentile(values, 0.99) * 1000:7.1f} ms   erreurs {errors.get(name, 0)}")
+    return 1 if errors else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Test de charge des routes chaudes")
+    parser.add_argument("url", nargs="?", default="http://localhost:8000")
+    parser.add_argument("--users", default="admin", help="identifiants séparés par des virgules")
+    parser.add_argument("--password", default="admin")
+    parser.add_argument("-c", "--concurrency", type=int, default=50)
+    parser.add_argument("-d", "--duration", type=float, default=20)
+    parser.add_argument("--lens-limit", type=int, default=3000, help="taille de la liste /lenses demandée")
+    sys.exit(asyncio.run(run(parser.parse_args())))
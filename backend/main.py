@@ -1,18 +1,37 @@
-from fastapi import FastAPI, Query, HTTPException, UploadFile, File
+from fastapi import FastAPI, Query, HTTPException, UploadFile, File, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy import create_engine, text
 from pydantic import BaseModel
 import os
-import shutil
 import json
 import re
 import gc
 import traceback
 import time
-from datetime import datetime
+import threading
+import heapq
+import hashlib
+import uuid
+import gzip
+import orjson
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from decimal import Decimal
+from datetime import datetime, date, time as dtime, timedelta
 from dotenv import load_dotenv
 from cryptography.fernet import Fernet
-import openpyxl
+from pricing import LensProfile, rank_lenses, network_allows_brand, up, catalog_exclusions
+from bulk_load import LENS_COLUMNS, bump_catalog_version, copy_rows, create_staging_table, build_staging_indexes, swap_staging_table, drop_staging_table, upsert_from_staging
+from xlsx_stream import XlsxReader
+from importer import normalize_string, iter_parsed_sheets, iter_user_rows, USER_UPSERT
+from async_db import env_flag, pool_options, create_async_db_engine
+from migrations import LATEST_VERSION, schema_version, migrate
+from cache import TTLCache
+from metrics import (HTTP_LATENCY, HTTP_REQUESTS, HANDLER_ERRORS, CATALOG_ROWS, CRYPTO_SECONDS, TimedQueuePool, TimedAsyncPool,
+                     route_label, observe_pools, record_import, render as render_metrics)
+from search import SEARCH_SQL, SEARCH_THRESHOLD, TrigramIndex
+from stats import apply_offer_stats, apply_offers_stats, read_offer_stats
 
 # 1. Configuration
 load_dotenv()
@@ -22,16 +41,36 @@ cipher = Fernet(ENCRYPTION_KEY.encode())
 
 app = FastAPI()
 
+@app.on_event("shutdown")
+async def close_async_engine():
+    if async_engine: await async_engine.dispose()
+
 # 2. Sécurité
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"], 
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor"],
 )
 
+# Latence et statut par route (GET /metrics)
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start, status = time.perf_counter(), 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = route_label(request)
+        HTTP_LATENCY.labels(route, request.method).observe(time.perf_counter() - start)
+        HTTP_REQUESTS.labels(route, request.method, str(status)).inc()
+
 # 3. Connexion BDD Robuste
 engine = None
+async_engine = None
+lens_search_trgm = False # pg_trgm disponible : /lenses/search interroge l'index GIN, sinon le snapshot mémoire
 if DATABASE_URL:
     if DATABASE_URL.startswith("postgres://"):
         DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
@@ -41,119 +80,336 @@ if DATABASE_URL:
         DATABASE_URL += f"{separator}sslmode=require"
 
     try:
-        # pool_pre_ping=True est vital pour la stabilité sur le cloud
-        engine = create_engine(DATABASE_URL, pool_pre_ping=True, pool_recycle=300)
-        with engine.begin() as conn:
-            # --- Table Utilisateurs (Auth) ---
-            conn.execute(text("""
-                CREATE TABLE IF NOT EXISTS users (
-                    username VARCHAR(100) PRIMARY KEY,
-                    shop_name TEXT,
-                    password TEXT,
-                    email TEXT,
-                    role VARCHAR(50) DEFAULT 'user',
-                    is_first_login BOOLEAN DEFAULT TRUE,
-                    settings JSONB -- Stockage des préférences (Filtres, Thème, etc.)
-                );
-            """))
-            
-            # Migration auto: Ajout colonne settings si manquante
-            try:
-                conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS settings JSONB;"))
-            except Exception as e: print(f"Info Migration Users: {e}")
-            
-            # Initialisation Admin par défaut
-            try:
-                user_count = conn.execute(text("SELECT COUNT(*) FROM users")).scalar()
-                if user_count == 0:
-                    print("⚠️ Base utilisateurs vide : Création de l'admin par défaut...")
-                    conn.execute(text("""
-                        INSERT INTO users (username, shop_name, password, email, role, is_first_login) 
-                        VALUES ('admin', 'ADMINISTRATION', 'admin', 'admin@podium.optique', 'admin', FALSE)
-                    """))
-                    print("✅ Utilisateur 'admin' créé (Mdp: admin)")
-            except Exception as e:
-                print(f"⚠️ Info Admin Init: {e}")
-
-            # --- Table Dossiers Clients ---
-            conn.execute(text("""
-                CREATE TABLE IF NOT EXISTS client_offers (
-                    id SERIAL PRIMARY KEY, 
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    username VARCHAR(100), -- Identifiant de l'adhérent
-                    encrypted_identity TEXT, 
-                    lens_details JSONB, 
-                    financials JSONB,
-                    tags JSONB -- Stockage structuré pour stats
-                );
-            """))
-            
-            # Migration automatique
-            try:
-                conn.execute(text("ALTER TABLE client_offers ADD COLUMN IF NOT EXISTS username VARCHAR(100);"))
-                conn.execute(text("ALTER TABLE client_offers ADD COLUMN IF NOT EXISTS tags JSONB;"))
-            except Exception as e: print(f"Info Migration Client Offers: {e}")
-
-            # --- Table Catalogue Verres ---
-            conn.execute(text("""
-                CREATE TABLE IF NOT EXISTS lenses (
-                    id SERIAL PRIMARY KEY, brand TEXT, name TEXT, commercial_code TEXT,
-                    geometry TEXT, design TEXT, index_mat TEXT, material TEXT, coating TEXT, 
-                    commercial_flow TEXT, color TEXT, 
-                    purchase_price DECIMAL(10,2), 
-                    purchase_price_bonifie DECIMAL(10,2), 
-                    purchase_price_super_bonifie DECIMAL(10,2),
-                    selling_price DECIMAL(10,2),
-                    sell_kalixia DECIMAL(10,2), sell_itelis DECIMAL(10,2), 
-                    sell_carteblanche DECIMAL(10,2), sell_seveane DECIMAL(10,2), 
-                    sell_santeclair DECIMAL(10,2)
-                );
-            """))
-            
-            # Migration automatique
-            try:
-                conn.execute(text("ALTER TABLE lenses ADD COLUMN IF NOT EXISTS purchase_price_bonifie DECIMAL(10,2) DEFAULT 0;"))
-                conn.execute(text("ALTER TABLE lenses ADD COLUMN IF NOT EXISTS purchase_price_super_bonifie DECIMAL(10,2) DEFAULT 0;"))
-            except Exception as e: print(f"Info Migration Lenses: {e}")
+        # pool_pre_ping (DB_POOL_PRE_PING, actif par défaut) est vital pour la stabilité sur le cloud
+        engine = create_engine(DATABASE_URL, poolclass=TimedQueuePool, **pool_options())
+        # Routes les plus sollicitées (login, catalogue, historique, stats) : asyncpg, sans thread par requête
+        async_engine = create_async_db_engine(DATABASE_URL, poolclass=TimedAsyncPool)
+        # Le schéma est géré par migrations.py : au démarrage, une simple lecture de version
+        with engine.connect() as conn: version = schema_version(conn)
+        if version < LATEST_VERSION:
+            if env_flag("MIGRATE_ON_STARTUP", True): migrate(engine)
+            else: print(f"⚠️ Schéma v{version} < v{LATEST_VERSION} : lancer 'python migrations.py'")
+        with engine.connect() as conn:
+            lens_search_trgm = conn.execute(text("SELECT EXISTS (SELECT 1 FROM pg_indexes WHERE indexname = 'idx_lenses_search_trgm')")).scalar()
 
     except Exception as e:
         print(f"❌ ERREUR BDD STARTUP: {e}")
-        engine = None
+        engine = async_engine = None
 
 # --- OUTILS ---
-def encrypt_dict(data): return cipher.encrypt(json.dumps(data).encode()).decode()
+def encrypt_dict(data):
+    with CRYPTO_SECONDS.labels("encrypt").time(): return cipher.encrypt(json.dumps(data).encode()).decode()
 def decrypt_dict(token): 
-    try: return json.loads(cipher.decrypt(token.encode()).decode())
+    try:
+        with CRYPTO_SECONDS.labels("decrypt").time(): return json.loads(cipher.decrypt(token.encode()).decode())
     except: return {"name": "Donnée", "firstname": "Illisible", "dob": "?"}
 
-def clean_price(value):
-    if not value or value == '' or value == '-': return 0.0
+# --- CACHE IDENTITÉS (déchiffrement Fernet à la demande) ---
+# LRU par dossier, entrées valables IDENTITY_CACHE_TTL secondes. IDENTITY_CACHE_SIZE=0 désactive le cache.
+identity_cache = TTLCache(int(os.getenv("IDENTITY_CACHE_SIZE", "2048")), float(os.getenv("IDENTITY_CACHE_TTL", "300")))
+
+def offer_identity(offer_id, token):
+    """Identité déchiffrée du dossier offer_id (dict partagé : ne pas modifier)."""
+    hit = identity_cache.get(offer_id)
+    # Le jeton est comparé : un id réattribué (TRUNCATE ... RESTART IDENTITY) ne renvoie pas l'ancienne identité
+    if hit and hit[0] == token: return hit[1]
+    return identity_cache.put(offer_id, (token, decrypt_dict(token)))[1]
+
+def forget_offer_identity(offer_id): identity_cache.pop(offer_id)
+
+# --- CACHE UTILISATEURS (rôle, magasin, réglages) ---
+# Invalidé à chaque écriture de ce worker ; USER_CACHE_TTL borne le retard vis-à-vis des autres workers.
+# Le mot de passe n'est jamais mis en cache : le login le relit toujours en base.
+user_cache = TTLCache(int(os.getenv("USER_CACHE_SIZE", "1024")), float(os.getenv("USER_CACHE_TTL", "60")))
+USER_FIELDS = "username, shop_name, email, role, is_first_login, settings"
+
+def get_user(conn, username):
+    """Fiche utilisateur {USER_FIELDS} (dict partagé : ne pas modifier), ou None si inconnu."""
+    user = user_cache.get(username)
+    if user is None:
+        row = conn.execute(text(f"SELECT {USER_FIELDS} FROM users WHERE username = :u"), {"u": username}).fetchone()
+        if row: user = user_cache.put(username, dict(row._mapping))
+    return user
+
+async def get_user_async(conn, username):
+    user = user_cache.get(username)
+    if user is None:
+        row = (await conn.execute(text(f"SELECT {USER_FIELDS} FROM users WHERE username = :u"), {"u": username})).fetchone()
+        if row: user = user_cache.put(username, dict(row._mapping))
+    return user
+
+
+# --- CACHE CATALOGUE (Snapshot mémoire versionné) ---
+# Chaque worker garde une copie figée de la table lenses. La version est relue en base
+# au plus toutes les CATALOG_VERSION_CHECK secondes (uploads faits par un autre worker).
+CATALOG_VERSION_CHECK = float(os.getenv("CATALOG_VERSION_CHECK", "30"))
+# Corps de réponse gardés par snapshot (LRU) : marque x type x limite x format x gzip x exclusions d'un opticien.
+# Borné en octets par worker (corps complet ~1,9 Mo en lignes, ~460 Ko en colonnes, plus la variante gzip).
+CATALOG_PAYLOAD_CACHE_MB = float(os.getenv("CATALOG_PAYLOAD_CACHE_MB", "64"))
+_catalog = None
+_catalog_checked_at = 0.0
+_catalog_lock = threading.RLock()
+
+def _price_key(row):
+    # Même ordre que "ORDER BY purchase_price ASC" (NULL en dernier)
+    p = row['purchase_price']
+    return (p is None, p or 0.0, row['id'])
+
+def _ilike_regex(pattern):
+    # Traduction d'un motif ILIKE (% et _) en regex insensible à la casse
+    out = "".join(".*" if ch == "%" else "." if ch == "_" else re.escape(ch) for ch in pattern)
+    return re.compile(f"^{out}$", re.IGNORECASE | re.DOTALL)
+
+def geometries_for_type(type):
+    """Traduit le paramètre 'type' du front en géométries exactes, ou en motif ILIKE."""
+    type_norm = normalize_string(type)
+    if "DEGRESSIF" in type_norm: return ['DEGRESSIF'], None
+    if "INTERIEUR" in type_norm: return ['PROGRESSIF_INTERIEUR', 'INTERIEUR'], None
+    if "PROGRESSIF" in type_norm: return ['PROGRESSIF'], None
+    if "UNIFOCAL" in type_norm: return ['UNIFOCAL'], None
+    if "MULTIFOCAL" in type_norm: return ['MULTIFOCAL'], None
+    return None, _ilike_regex(f"%{type}%")
+
+FACET_FIELDS = ("design", "index_mat", "material", "coating", "commercial_flow")
+
+def _index_sort_key(value):
+    try: return (0, float(str(value).replace(',', '.')), value)
+    except ValueError: return (1, 0.0, value)
+
+def payload_size(value):
+    # Poids d'une entrée du cache catalogue : taille du corps (les compteurs comptent pour peu)
+    return len(value) if isinstance(value, (bytes, str)) else 64
+
+class CatalogSnapshot:
+    """Copie immuable du catalogue, triée par prix d'achat et indexée par (marque, géométrie)."""
+    def __init__(self, version, rows):
+        self.version = version
+        self.rows = sorted(rows, key=_price_key)
+        self.index = {}
+        self._payloads = TTLCache(int(CATALOG_PAYLOAD_CACHE_MB * 1024 * 1024), float("inf"), weigh=payload_size)
+        self._search_index = None
+        for r in self.rows:
+            b = (r['brand'] or '').upper()
+            g = r['geometry'] or ''
+            for key in ((None, None), (b, None), (None, g), (b, g)):
+                self.index.setdefault(key, []).append(r)
+        # Colonnes de prix/règles précalculées pour le classement par marge
+        self.profiles = {r['id']: LensProfile(r) for r in self.rows}
+        # Index de facettes : compteurs par (marque, géométrie, réseau) ; HORS_RESEAU = tout le catalogue
+        self.facets = {}
+        for r in self.rows:
+            prof = self.profiles[r['id']]
+            for net in ['HORS_RESEAU'] + [n for n, v in prof.sell.items() if v > 0]:
+                bucket = self.facets.get((prof.brand, r['geometry'] or '', net))
+                if bucket is None: bucket = self.facets[(prof.brand, r['geometry'] or '', net)] = {"total": 0, **{f: Counter() for f in FACET_FIELDS}}
+                bucket["total"] += 1
+                for f in FACET_FIELDS:
+                    if r[f]: bucket[f][r[f]] += 1
+
+    def select(self, brand=None, type=None, limit=3000, exclusions=None):
+        brand_key, brand_re = None, None
+        if brand:
+            if '%' in brand or '_' in brand: brand_re = _ilike_regex(brand)
+            else: brand_key = brand.upper()
+        geos, geo_re = geometries_for_type(type) if type else (None, None)
+        if geos:
+            parts = [self.index.get((brand_key, g), []) for g in geos]
+            rows = parts[0] if len(parts) == 1 else list(heapq.merge(*parts, key=_price_key))
+        else:
+            rows = self.index.get((brand_key, None), [])
+        if brand_re: rows = [r for r in rows if brand_re.match(r['brand'] or '')]
+        if geo_re: rows = [r for r in rows if geo_re.match(r['geometry'] or '')]
+        if exclusions and any(exclusions):
+            # Vue d'un utilisateur : mêmes filtres que le front (marques masquées seulement sans marque choisie)
+            brands, designs, materials = exclusions
+            if brand: brands = ()
+            profiles = self.profiles
+            rows = [r for r in rows if (p := profiles[r['id']]).design not in designs and p.material not in materials and p.brand not in brands]
+        return rows[:max(limit, 0)]
+
+    def facet_counts(self, brand=None, type=None, network=None):
+        network = up(network) or 'HORS_RESEAU'
+        brand_key = up(brand)
+        geos, geo_re = geometries_for_type(type) if type else (None, None)
+        total, counts = 0, {f: Counter() for f in FACET_FIELDS}
+        for (b, g, net), bucket in self.facets.items():
+            if net != network: continue
+            if brand_key and b != brand_key: continue
+            if not brand_key and not network_allows_brand(network, b): continue
+            if geos and g not in geos: continue
+            if geo_re and not geo_re.match(g): continue
+            total += bucket["total"]
+            for f in FACET_FIELDS: counts[f].update(bucket[f])
+        facets = {}
+        for f in FACET_FIELDS:
+            order = sorted(counts[f], key=_index_sort_key if f == "index_mat" else str)
+            facets[f] = [{"value": v, "count": counts[f][v]} for v in order]
+        return {"version": self.version, "total": total, "facets": facets}
+
+    def search_index(self):
+        # Construit à la première recherche sans pg_trgm
+        if self._search_index is None: self._search_index = TrigramIndex(self.rows)
+        return self._search_index
+
+    def payload(self, key, build):
+        # Corps JSON déjà sérialisé, valable tant que ce snapshot est le courant (les moins demandés sont évincés)
+        body = self._payloads.get(key)
+        if body is None: body = self._payloads.put(key, build())
+        return body
+
+    def cached(self, key): return self._payloads.get(key)
+
+# Format colonnes (?format=columnar ou Accept) : une liste de valeurs par colonne, et pour les textes
+# très répétés un dictionnaire de valeurs distinctes + les indices de chaque verre.
+COLUMNAR_MEDIA_TYPE = "application/vnd.podium.columnar+json"
+COLUMNAR_DICT_FIELDS = ("brand", "geometry", "design", "index_mat", "material", "coating", "commercial_flow", "color")
+
+def columnar(rows, version):
+    names = list(rows[0]) if rows else []
+    columns, dicts = {}, {}
+    for name in names:
+        values = [r[name] for r in rows]
+        if name in COLUMNAR_DICT_FIELDS:
+            codes = {}
+            columns[name] = [codes.setdefault(v, len(codes)) for v in values]
+            dicts[name] = list(codes)
+        else: columns[name] = values
+    return {"version": version, "count": len(rows), "names": names, "columns": columns, "dicts": dicts}
+
+def wants_columnar(request, format):
+    if format: return format == "columnar"
+    return COLUMNAR_MEDIA_TYPE in request.headers.get("accept", "")
+
+def _plain_row(row):
+    return {k: float(v) if isinstance(v, Decimal) else v for k, v in row._mapping.items()}
+
+def reload_catalog(version=None):
+    """Relit la table lenses et remplace le snapshot courant d'un seul coup."""
+    global _catalog, _catalog_checked_at
+    with _catalog_lock:
+        with engine.connect() as conn:
+            if version is None: version = conn.execute(text("SELECT version FROM catalog_meta WHERE id = 1")).scalar() or 0
+            rows = conn.execute(text("SELECT * FROM lenses")).fetchall()
+        _catalog = CatalogSnapshot(version, [_plain_row(r) for r in rows])
+        _catalog_checked_at = time.monotonic()
+        print(f"📦 Catalogue v{version} en mémoire ({len(rows)} verres)", flush=True)
+        return _catalog
+
+CATALOG_IMPORT_LOCK = 7204519 # clé pg_advisory_lock des imports catalogue
+
+def catalog_etag(version, *parts):
+    digest = hashlib.sha1("|".join(str(p) for p in (version, *parts)).encode()).hexdigest()[:24]
+    return f'"cat-{version}-{digest}"'
+
+def exclusions_key(exclusions):
+    # Empreinte stable des listes masquées : clé de cache et d'ETag de la vue par utilisateur
+    if not exclusions or not any(exclusions): return ""
+    return hashlib.md5(json.dumps([sorted(x) for x in exclusions], separators=(",", ":")).encode()).hexdigest()[:16]
+
+def catalog_response(request, catalog, key, build, media_type="application/json"):
+    """Réponse catalogue : corps mis en cache sur le snapshot (et sa version gzip), ETag et 304."""
+    etag = catalog_etag(catalog.version, *key)
+    gz_etag = etag[:-1] + '-gz"'
+    # no-cache : le navigateur garde la réponse mais revalide toujours avec If-None-Match
+    headers = {"Cache-Control": "no-cache", "Vary": "Accept, Accept-Encoding"}
+    inm = request.headers.get("if-none-match")
+    # 304 : on reprend l'ETag de la représentation que le client a déjà
+    for tag in (etag, gz_etag):
+        if etag_matches(inm, tag): return Response(status_code=304, headers={**headers, "ETag": tag})
+    body = catalog.payload(key, build)
+    # Suffixe -gz seulement pour un corps réellement compressé : un ETag = une représentation
+    if "gzip" in request.headers.get("accept-encoding", "") and len(body) > 1024:
+        body = catalog.payload(key + ("gzip",), lambda: gzip.compress(body if isinstance(body, bytes) else body.encode(), 6))
+        headers["ETag"], headers["Content-Encoding"] = gz_etag, "gzip"
+    else: headers["ETag"] = etag
+    return Response(content=body, media_type=media_type, headers=headers)
+
+async def catalog_response_async(request, catalog, key, build, media_type="application/json"):
+    # Corps absent du cache : sérialisation (jusqu'à ~2 Mo) et gzip dans un thread, pas sur la boucle d'événements
+    body = catalog.cached(key)
+    if body is not None and ("gzip" not in request.headers.get("accept-encoding", "") or len(body) <= 1024 or catalog.cached(key + ("gzip",)) is not None):
+        return catalog_response(request, catalog, key, build, media_type)
+    return await run_in_threadpool(catalog_response, request, catalog, key, build, media_type)
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match: return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or any(t.removeprefix("W/") == etag for t in tags)
+
+def get_catalog():
+    global _catalog_checked_at
+    snap = _catalog
+    if snap is not None and time.monotonic() - _catalog_checked_at < CATALOG_VERSION_CHECK: return snap
+    with _catalog_lock:
+        if _catalog is not None and time.monotonic() - _catalog_checked_at < CATALOG_VERSION_CHECK: return _catalog
+        try:
+            with engine.connect() as conn:
+                version = conn.execute(text("SELECT version FROM catalog_meta WHERE id = 1")).scalar() or 0
+        except Exception as e:
+            # BDD injoignable : on continue de servir l'ancien snapshot s'il existe
+            if _catalog is None: raise
+            print(f"⚠️ Version catalogue illisible: {e}")
+            _catalog_checked_at = time.monotonic()
+            return _catalog
+        if _catalog is None or _catalog.version != version: return reload_catalog(version)
+        _catalog_checked_at = time.monotonic()
+        return _catalog
+
+async def get_catalog_async():
+    # Snapshot à jour : aucune E/S. Sinon relecture de version (et rechargement éventuel) dans un thread.
+    snap = _catalog
+    if snap is not None and time.monotonic() - _catalog_checked_at < CATALOG_VERSION_CHECK: return snap
+    return await run_in_threadpool(get_catalog)
+
+# --- IMPORTS CATALOGUE (TÂCHES DE FOND) ---
+# L'état des tâches est recopié dans catalog_import_jobs : n'importe quel worker peut répondre au suivi.
+import_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="catalog-import")
+IMPORT_PROGRESS_INTERVAL = 0.5 # secondes entre deux écritures de progression
+
+class ImportJob:
+    def __init__(self, job_id, filename, mode="replace"):
+        self.id, self.filename, self.mode = job_id, filename, mode
+        self.status, self.phase, self.error = "queued", "queued", None
+        self.sheets = {} # feuille -> {"read", "parsed", "inserted"}
+        self.count, self.version = 0, None
+        self.changes = None # mode "diff" : {"inserted", "updated", "deleted", "unchanged"}
+        self._saved_at = 0.0
+
+    def sheet(self, name): return self.sheets.setdefault(name, {"read": 0, "parsed": 0, "inserted": 0})
+
+    def progress(self):
+        return {"phase": self.phase, "mode": self.mode, "sheets": self.sheets, "count": self.count, "version": self.version, "changes": self.changes,
+                "parsed": sum(p["parsed"] for p in self.sheets.values()), "inserted": sum(p["inserted"] for p in self.sheets.values())}
+
+    def create(self):
+        with engine.begin() as conn:
+            conn.execute(text("INSERT INTO catalog_import_jobs (id, filename, status, progress) VALUES (:id, :f, 'queued', :p)"), {"id": self.id, "f": self.filename, "p": json.dumps(self.progress())})
+
+    def save(self, force=False, **columns):
+        now = time.monotonic()
+        if not force and now - self._saved_at < IMPORT_PROGRESS_INTERVAL: return
+        self._saved_at = now
+        sets = "".join(f", {col} = {expr}" for col, expr in columns.items())
+        try:
+            with engine.begin() as conn:
+                conn.execute(text(f"UPDATE catalog_import_jobs SET status = :s, progress = :p, error = :e{sets} WHERE id = :id"),
+                             {"id": self.id, "s": self.status, "p": json.dumps(self.progress()), "e": self.error})
+        except Exception as e: print(f"⚠️ Suivi import {self.id}: {e}")
+
+    def start(self): self.status = self.phase = "running"; self.save(force=True, started_at="CURRENT_TIMESTAMP")
+    def finish(self, count, version):
+        self.status = self.phase = "success"; self.count, self.version = count, version
+        self.save(force=True, finished_at="CURRENT_TIMESTAMP")
+    def fail(self, error):
+        self.status, self.error = "error", error
+        self.save(force=True, finished_at="CURRENT_TIMESTAMP")
+
+def _release_import_lock(lock_conn):
     try:
-        clean_str = str(value).replace('€', '').replace('â‚¬', '').replace('%', '').replace(' ', '').replace('\xa0', '').replace(',', '.')
-        return float(clean_str)
-    except: return 0.0
-
-def clean_index(value):
-    if not value: return "1.50"
-    match = re.search(r"\d+\.?\d*", str(value).replace(',', '.'))
-    return "{:.2f}".format(float(match.group(0))) if match else "1.50"
-
-def clean_text(value): return str(value).strip() if value else ""
-
-def normalize_string(text):
-    if not text: return ""
-    text = str(text).upper().strip()
-    replacements = {'É': 'E', 'È': 'E', 'Ê': 'E', 'Ë': 'E', 'À': 'A', 'Â': 'A', 'Î': 'I', 'Ï': 'I', 'Ô': 'O', 'Ù': 'U', 'Ç': 'C'}
-    for acc, char in replacements.items(): text = text.replace(acc, char)
-    return text
-
-def get_col_idx(headers, candidates):
-    for i, h in enumerate(headers):
-        if h:
-            h_str = normalize_string(h)
-            for c in candidates:
-                if normalize_string(c) in h_str: return i
-    return -1
+        lock_conn.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": CATALOG_IMPORT_LOCK})
+        lock_conn.commit()
+    except Exception as e: print(f"⚠️ Verrou import: {e}")
+    finally: lock_conn.close()
 
 # --- MODELES ---
 class LoginRequest(BaseModel): username: str; password: str
@@ -165,21 +421,24 @@ class OfferRequest(BaseModel):
     lens: dict
     finance: dict
     tags: dict 
+class IdentityRequest(BaseModel): username: str; ids: list[int]
 
 # --- ROUTES AUTHENTIFICATION ---
 @app.post("/auth/login")
-def login(creds: LoginRequest):
-    if not engine: raise HTTPException(500, "Pas de BDD")
+async def login(creds: LoginRequest):
+    if not async_engine: raise HTTPException(500, "Pas de BDD")
     try:
-        with engine.connect() as conn:
-            result = conn.execute(text("SELECT * FROM users WHERE LOWER(username) = LOWER(:u)"), {"u": creds.username}).fetchone()
+        async with async_engine.connect() as conn:
+            # Index idx_users_lower_username ; fiche relue en base (un seul aller-retour) puis remise en cache
+            result = (await conn.execute(text(f"SELECT {USER_FIELDS}, password FROM users WHERE LOWER(username) = LOWER(:u)"), {"u": creds.username})).fetchone()
             if not result: raise HTTPException(401, "Utilisateur inconnu")
-            user = result._mapping
-            if user['password'] != creds.password: raise HTTPException(401, "Mot de passe incorrect")
-            role = user['role'] if 'role' in user else 'user'
+            if result.password != creds.password: raise HTTPException(401, "Mot de passe incorrect")
+            user = dict(result._mapping); del user['password']
+            user_cache.put(user['username'], user)
+            role = user['role']
             
             # On renvoie aussi les settings sauvegardés
-            settings = user['settings'] if 'settings' in user and user['settings'] else {}
+            settings = user['settings'] or {}
             
             return {
                 "status": "success",
@@ -206,6 +465,7 @@ def update_password(data: PasswordUpdate):
             if not current_user: raise HTTPException(404, "Utilisateur introuvable")
             if current_user.password != data.old_password: raise HTTPException(403, "L'ancien mot de passe est incorrect")
             conn.execute(text("UPDATE users SET password = :p, is_first_login = FALSE WHERE username = :u"), {"p": data.new_password, "u": data.username})
+        user_cache.pop(data.username)
         return {"status": "success"}
     except Exception as e: 
         if isinstance(e, HTTPException): raise e
@@ -220,6 +480,7 @@ def update_user_settings(data: SettingsUpdate):
             # On met à jour la colonne settings (JSONB)
             conn.execute(text("UPDATE users SET settings = :s WHERE username = :u"), 
                          {"s": json.dumps(data.settings), "u": data.username})
+        user_cache.pop(data.username)
         return {"status": "success"}
     except Exception as e:
         print(f"Settings Save Error: {e}")
@@ -229,53 +490,30 @@ def update_user_settings(data: SettingsUpdate):
 def upload_users(file: UploadFile = File(...)):
     print("🚀 Upload USERS (Mode UPSERT)...", flush=True)
     if not engine: raise HTTPException(500, "Pas de BDD")
-    temp = f"/tmp/users_{int(time.time())}.xlsx"
+    reader, started = None, time.perf_counter()
     try:
-        with open(temp, "wb") as buffer: shutil.copyfileobj(file.file, buffer)
-        wb = openpyxl.load_workbook(temp, data_only=True)
-        sheet = wb.active
-        rows = list(sheet.iter_rows(values_only=True))
-        if not rows: raise Exception("Fichier vide")
-        header_idx = -1; headers = []
-        for i, row in enumerate(rows[:20]):
-            row_str = [str(c).upper() for c in row if c]
-            if any(k in s for s in row_str for k in ["IDENTIFIANT", "USERNAME", "LOGIN", "ID CLIENT"]):
-                headers, header_idx = row, i; break
-        if header_idx == -1: headers, header_idx = rows[0], 0
-        c_id = get_col_idx(headers, ['IDENTIFIANT', 'ID', 'USERNAME', 'LOGIN'])
-        c_shop = get_col_idx(headers, ['MAGASIN', 'SHOP', 'RAISON SOCIALE', 'NOM'])
-        c_pass = get_col_idx(headers, ['PASSWORD', 'MOT DE PASSE', 'MDP'])
-        c_mail = get_col_idx(headers, ['MAIL', 'EMAIL', 'COURRIEL'])
-        c_role = get_col_idx(headers, ['ROLE', 'TYPE', 'DROIT'])
-        if c_id == -1: raise Exception("Colonne Identifiant manquante")
-        users_to_insert = []
-        for row in rows[header_idx+1:]:
-            if not row[c_id]: continue 
-            u_id = str(row[c_id]).strip()
-            u_shop = str(row[c_shop]).strip() if c_shop != -1 and row[c_shop] else "Opticien"
-            u_pass = str(row[c_pass]).strip() if c_pass != -1 and row[c_pass] else "1234"
-            u_mail = str(row[c_mail]).strip() if c_mail != -1 and row[c_mail] else ""
-            u_role = "user"
-            if c_role != -1 and row[c_role]:
-                val_role = str(row[c_role]).lower().strip()
-                if "admin" in val_role: u_role = "admin"
-            users_to_insert.append({ "u": u_id, "s": u_shop, "p": u_pass, "e": u_mail, "r": u_role })
+        # Lecture en flux directement dans le fichier d'upload (pas de copie dans /tmp)
+        reader = XlsxReader(file.file)
+        users_to_insert = list(iter_user_rows(reader.iter_rows(reader.active)))
         if users_to_insert:
             with engine.begin() as conn:
-                conn.execute(text("""
-                    INSERT INTO users (username, shop_name, password, email, role, is_first_login)
-                    VALUES (:u, :s, :p, :e, :r, TRUE)
-                    ON CONFLICT (username) DO UPDATE SET
-                        shop_name = EXCLUDED.shop_name,
-                        email = EXCLUDED.email,
-                        role = EXCLUDED.role;
-                """), users_to_insert)
+                conn.execute(text(USER_UPSERT), users_to_insert)
+        user_cache.clear()
+        record_import("users", len(users_to_insert), time.perf_counter() - started)
         return {"status": "success", "count": len(users_to_insert), "mode": "upsert_safe"}
     except Exception as e: 
         print(f"❌ ERREUR: {traceback.format_exc()}", flush=True)
         raise HTTPException(500, f"Erreur: {str(e)}")
     finally:
-        if os.path.exists(temp): os.remove(temp)
+        if reader: reader.close()
+
+# --- SUPERVISION ---
+@app.get("/metrics")
+def get_metrics():
+    # Format texte Prometheus : latences par route, pools de connexions, Fernet, imports
+    observe_pools({"sync": engine, "async": async_engine})
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
 
 # --- ROUTES ADMIN ---
 @app.get("/admin/users")
@@ -285,59 +523,20 @@ def get_all_users():
         with engine.connect() as conn:
             res = conn.execute(text("SELECT username, shop_name FROM users ORDER BY shop_name"))
             return [dict(r._mapping) for r in res]
-    except: return []
+    except:
+        HANDLER_ERRORS.labels("/users").inc()
+        return []
 
 @app.get("/admin/stats")
-def get_user_stats(username: str = Query(...)):
-    if not engine: return {}
+async def get_user_stats(username: str = Query(...)):
+    if not async_engine: return {}
     try:
-        with engine.connect() as conn:
-            if username == "all":
-                res = conn.execute(text("SELECT tags, lens_details, financials FROM client_offers WHERE tags IS NOT NULL"))
-            else:
-                res = conn.execute(text("SELECT tags, lens_details, financials FROM client_offers WHERE username = :u AND tags IS NOT NULL"), {"u": username})
-            rows = res.fetchall()
-            categories = ["network", "geometry", "design", "index", "material", "coating", "commercial_flow"]
-            stats = {cat: {} for cat in categories}
-            top_data = { "UNIFOCAL": {}, "PROGRESSIF": {} }
-            total_sales = 0
-            total_revenue = 0.0
-            for r in rows:
-                tags = r.tags
-                if not tags: continue
-                try:
-                    price = float(r.financials.get('total', 0))
-                    unit_sell = float(r.lens_details.get('sellingPrice', 0))
-                    unit_buy = float(r.lens_details.get('purchase_price', 0))
-                    margin = (unit_sell - unit_buy) * 2
-                except: price = 0.0; margin = 0.0
-                total_sales += 1
-                total_revenue += price
-                for cat in categories:
-                    val = tags.get(cat, "N/A") or "N/A"
-                    if val not in stats[cat]: stats[cat][val] = {"volume": 0, "value": 0.0}
-                    stats[cat][val]["volume"] += 1
-                    stats[cat][val]["value"] += price
-                geo_raw = str(tags.get('geometry', '')).upper()
-                design_name = str(tags.get('design', 'INCONNU'))
-                target_geo = None
-                if 'UNIFOCAL' in geo_raw: target_geo = "UNIFOCAL"
-                elif 'PROGRESSIF' in geo_raw or 'INTERIEUR' in geo_raw: target_geo = "PROGRESSIF"
-                if target_geo:
-                    if design_name not in top_data[target_geo]: top_data[target_geo][design_name] = {"volume": 0, "value": 0.0, "margin": 0.0}
-                    top_data[target_geo][design_name]["volume"] += 1
-                    top_data[target_geo][design_name]["value"] += price
-                    top_data[target_geo][design_name]["margin"] += margin
-            final_tops = {"UNIFOCAL": {}, "PROGRESSIF": {}}
-            for geo in ["UNIFOCAL", "PROGRESSIF"]:
-                items = [{"name": k, **v} for k, v in top_data[geo].items()]
-                final_tops[geo] = {
-                    "by_volume": sorted(items, key=lambda x: x['volume'], reverse=True)[:3],
-                    "by_value": sorted(items, key=lambda x: x['value'], reverse=True)[:3],
-                    "by_margin": sorted(items, key=lambda x: x['margin'], reverse=True)[:3]
-                }
-            return { "total_sales": total_sales, "total_revenue": total_revenue, "breakdown": stats, "tops": final_tops }
-    except: return {}
+        # read_offer_stats reste synchrone : exécuté sur la connexion asyncpg via run_sync
+        async with async_engine.connect() as conn: return await conn.run_sync(read_offer_stats, username)
+    except Exception as e:
+        print(f"Erreur get_user_stats: {e}")
+        HANDLER_ERRORS.labels("/admin/stats").inc()
+        return {}
 
 # --- ROUTES DOSSIERS (SÉCURISÉE) ---
 @app.post("/offers")
@@ -348,179 +547,338 @@ def save_offer(offer: OfferRequest):
             lens_data = offer.lens
             if hasattr(offer, 'correction') and offer.correction: lens_data['correction_data'] = offer.correction
             # On enregistre l'identifiant adhérent (username)
-            conn.execute(text("INSERT INTO client_offers (username, encrypted_identity, lens_details, financials, tags) VALUES (:u, :ident, :lens, :fin, :tags)"), {
+            offer_id = conn.execute(text("INSERT INTO client_offers (username, encrypted_identity, lens_details, financials, tags) VALUES (:u, :ident, :lens, :fin, :tags) RETURNING id"), {
                 "u": offer.username, "ident": encrypt_dict(offer.client), "lens": json.dumps(lens_data), "fin": json.dumps(offer.finance), "tags": json.dumps(offer.tags)
-            })
+            }).scalar()
+            apply_offer_stats(conn, offer_id, offer.username, offer.tags, lens_data, offer.finance)
         return {"status": "success"}
     except Exception as e: raise HTTPException(500, str(e))
 
+# Lot d'offres (synchronisation hors ligne) : chiffrement en parallèle, un seul COPY, une seule transaction
+OFFER_BATCH_MAX = 1000
+OFFER_COLUMNS = ("id", "username", "encrypted_identity", "lens_details", "financials", "tags")
+crypto_executor = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix="offer-crypto")
+
+@app.post("/offers/batch")
+def save_offers_batch(items: list[dict]):
+    """Enregistre une liste d'offres ; renvoie pour chacune {"index", "id"} ou {"index", "error"} (offre invalide ignorée)."""
+    if not engine: raise HTTPException(500, "Pas de connexion BDD")
+    if len(items) > OFFER_BATCH_MAX: raise HTTPException(413, f"Lot limité à {OFFER_BATCH_MAX} offres")
+    results, offers = [None] * len(items), []
+    for i, item in enumerate(items):
+        try: offers.append((i, OfferRequest.model_validate(item)))
+        except Exception as e: results[i] = {"index": i, "error": str(e)}
+    try:
+        if offers:
+            idents = list(crypto_executor.map(encrypt_dict, [o.client for _, o in offers]))
+            with engine.begin() as conn:
+                # Ids réservés d'avance : le COPY ne renvoie rien, et l'ordre du lot est conservé
+                ids = sorted(conn.execute(text("SELECT nextval(pg_get_serial_sequence('client_offers', 'id')) FROM generate_series(1, :n)"), {"n": len(offers)}).scalars())
+                rows = [(offer_id, o.username, ident, json.dumps(o.lens), json.dumps(o.finance), json.dumps(o.tags)) for offer_id, (_, o), ident in zip(ids, offers, idents)]
+                copy_rows(conn, "client_offers", OFFER_COLUMNS, rows)
+                apply_offers_stats(conn, [(offer_id, o.username, o.tags, o.lens, o.finance) for offer_id, (_, o) in zip(ids, offers)])
+            for offer_id, (i, _) in zip(ids, offers): results[i] = {"index": i, "id": offer_id}
+        return {"status": "success", "inserted": len(offers), "results": results}
+    except Exception as e: raise HTTPException(500, str(e))
+
+# Historique paginé par curseur (created_at, id) : chaque page coûte un parcours d'index, quelle que soit sa profondeur
+OFFER_FIELDS = {
+    "full": "id, created_at, username, lens_details, financials",
+    # Liste d'historique : pas de correction ni de détail verre complet
+    "summary": "id, created_at, username, jsonb_build_object('name', lens_details->'name', 'commercial_code', lens_details->'commercial_code', 'brand', lens_details->'brand') AS lens_details, financials",
+}
+# inline : identité déchiffrée dans chaque dossier ; handle : "client" vide, à demander à POST /offers/identities
+OFFER_IDENTITY_MODES = ("inline", "handle")
+
+def encode_offer_cursor(created_at, offer_id): return f"{created_at.isoformat()}_{offer_id}"
+
+def decode_offer_cursor(cursor):
+    try:
+        created_at, offer_id = cursor.rsplit("_", 1)
+        return datetime.fromisoformat(created_at), int(offer_id)
+    except ValueError: raise HTTPException(400, "Curseur invalide")
+
 @app.get("/offers")
-def get_offers(username: str = Query(...), target_user: str = Query(None)):
-    if not engine: return []
+async def get_offers(response: Response, username: str = Query(...), target_user: str = Query(None), cursor: str = Query(None),
+               limit: int = Query(100), date_from: date = Query(None), date_to: date = Query(None),
+               network: str = Query(None), geometry: str = Query(None), fields: str = Query("full"), identity: str = Query("inline")):
+    if not async_engine: return []
+    if fields not in OFFER_FIELDS: raise HTTPException(400, f"Champs inconnus: {fields}")
+    if identity not in OFFER_IDENTITY_MODES: raise HTTPException(400, f"Mode identité inconnu: {identity}")
+    inline = identity == "inline"
+    limit = max(1, min(limit, 500))
+    where, params = [], {"limit": limit + 1}
+    if cursor:
+        where.append("(created_at, id) < (:c_at, :c_id)")
+        params["c_at"], params["c_id"] = decode_offer_cursor(cursor)
+    if date_from: where.append("created_at >= :d_from"); params["d_from"] = datetime.combine(date_from, dtime.min)
+    if date_to: where.append("created_at < :d_to"); params["d_to"] = datetime.combine(date_to + timedelta(days=1), dtime.min)
+    if network: where.append("tags->>'network' = :network"); params["network"] = network
+    if geometry: where.append("tags->>'geometry' = :geometry"); params["geometry"] = geometry
     try:
-        with engine.connect() as conn:
-            user_row = conn.execute(text("SELECT role FROM users WHERE username = :u"), {"u": username}).fetchone()
+        async with async_engine.connect() as conn:
+            user_row = await get_user_async(conn, username)
             if not user_row: return [] 
-            is_admin = user_row.role == 'admin'
-            if is_admin:
-                if target_user:
-                     sql = "SELECT * FROM client_offers WHERE username = :t ORDER BY created_at DESC LIMIT 100"
-                     params = {"t": target_user}
-                else:
-                     sql = "SELECT * FROM client_offers ORDER BY created_at DESC LIMIT 100"
-                     params = {}
-            else:
-                sql = "SELECT * FROM client_offers WHERE username = :u ORDER BY created_at DESC LIMIT 100"
-                params = {"u": username}
-            res = conn.execute(text(sql), params)
-            results = []
-            for r in res.fetchall():
-                try:
-                    lens_data = r.lens_details
-                    correction = lens_data.get('correction_data', None)
-                    results.append({
-                        "id": r.id, "date": r.created_at.strftime("%d/%m/%Y %H:%M"), 
-                        "client": decrypt_dict(r.encrypted_identity), "lens": lens_data, 
-                        "finance": r.financials, "correction": correction, "owner": r.username 
-                    })
-                except: continue
-            return results
+            is_admin = user_row['role'] == 'admin'
+            # Un adhérent ne voit que ses dossiers ; l'admin voit tout ou filtre sur un adhérent
+            owner = (target_user or None) if is_admin else username
+            if owner: where.append("username = :owner"); params["owner"] = owner
+            sql = f"SELECT {OFFER_FIELDS[fields]}{', encrypted_identity' if inline else ''} FROM client_offers"
+            if where: sql += " WHERE " + " AND ".join(where)
+            sql += " ORDER BY created_at DESC, id DESC LIMIT :limit"
+            rows = (await conn.execute(text(sql), params)).fetchall()
+        # Une ligne de plus que la page : indique s'il reste des dossiers plus anciens
+        if len(rows) > limit:
+            rows = rows[:limit]
+            response.headers["X-Next-Cursor"] = encode_offer_cursor(rows[-1].created_at, rows[-1].id)
+        # Déchiffrement Fernet (CPU) hors de la boucle d'événements
+        if inline: return await run_in_threadpool(_offer_items, rows, True)
+        return _offer_items(rows, False)
     except Exception as e: 
         print(f"Erreur get_offers: {e}")
+        HANDLER_ERRORS.labels("/offers").inc()
         return []
 
+def _offer_items(rows, inline):
+    results = []
+    for r in rows:
+        try:
+            lens_data = r.lens_details
+            correction = lens_data.get('correction_data', None)
+            results.append({
+                "id": r.id, "date": r.created_at.strftime("%d/%m/%Y %H:%M"), 
+                "client": offer_identity(r.id, r.encrypted_identity) if inline else None, "identity": r.id, "lens": lens_data, 
+                "finance": r.financials, "correction": correction, "owner": r.username 
+            })
+        except: continue
+    return results
+
+@app.post("/offers/identities")
+def get_offer_identities(req: IdentityRequest):
+    """Identités déchiffrées des dossiers affichés ({id: client}) ; un adhérent n'obtient que les siens."""
+    if not engine: raise HTTPException(500, "Pas de BDD")
+    ids = list(dict.fromkeys(req.ids))[:500]
+    if not ids: return {}
+    try:
+        with engine.connect() as conn:
+            user_row = get_user(conn, req.username)
+            if not user_row: raise HTTPException(403, "Accès refusé")
+            sql = "SELECT id, encrypted_identity FROM client_offers WHERE id = ANY(:ids)"
+            if user_row['role'] != 'admin': sql += " AND username = :u"
+            rows = conn.execute(text(sql), {"ids": ids, "u": req.username}).fetchall()
+        return {str(r.id): offer_identity(r.id, r.encrypted_identity) for r in rows}
+    except HTTPException: raise
+    except Exception as e: raise HTTPException(500, str(e))
+
 @app.delete("/offers/{offer_id}")
 def delete_offer(offer_id: int):
     if not engine: raise HTTPException(500, "Pas de BDD")
     try:
         with engine.begin() as conn:
-            if conn.execute(text("DELETE FROM client_offers WHERE id = :id"), {"id": offer_id}).rowcount == 0: raise HTTPException(404, "Introuvable")
+            deleted = conn.execute(text("DELETE FROM client_offers WHERE id = :id RETURNING username, tags, lens_details, financials"), {"id": offer_id}).fetchone()
+            if not deleted: raise HTTPException(404, "Introuvable")
+            apply_offer_stats(conn, offer_id, deleted.username, deleted.tags, deleted.lens_details, deleted.financials, sign=-1)
+        forget_offer_identity(offer_id)
         return {"status": "success"}
     except Exception as e: raise HTTPException(500, str(e))
 
 # --- ROUTES CATALOGUE ---
 @app.get("/lenses")
-def get_lenses(type: str = Query(None), brand: str = Query(None), limit: int = Query(3000)):
+async def get_lenses(request: Request, type: str = Query(None), brand: str = Query(None), limit: int = Query(3000), for_user: str = Query(None),
+                     format: str = Query(None)):
     if not engine: return []
     try:
-        with engine.connect() as conn:
-            sql = f"SELECT * FROM lenses WHERE 1=1"
-            params = {}
-            if brand: sql += " AND brand ILIKE :brand"; params["brand"] = brand
-            if type: 
-                type_norm = normalize_string(type)
-                if "DEGRESSIF" in type_norm: sql += " AND geometry = 'DEGRESSIF'"
-                elif "INTERIEUR" in type_norm: sql += " AND (geometry = 'PROGRESSIF_INTERIEUR' OR geometry = 'INTERIEUR')"
-                elif "PROGRESSIF" in type_norm: sql += " AND geometry = 'PROGRESSIF'"
-                elif "UNIFOCAL" in type_norm: sql += " AND geometry = 'UNIFOCAL'"
-                elif "MULTIFOCAL" in type_norm: sql += " AND geometry = 'MULTIFOCAL'"
-                else: sql += " AND geometry ILIKE :geo"; params["geo"] = f"%{type}%"
-            sql += f" ORDER BY purchase_price ASC LIMIT {min(limit, 5000)}"
-            rows = conn.execute(text(sql), params).fetchall()
-            return [row._mapping for row in rows]
-    except: return []
-
-@app.post("/upload-catalog")
-def upload_catalog(file: UploadFile = File(...)):
-    print("🚀 Upload Catalogue...", flush=True)
+        exclusions = None
+        if for_user:
+            # Catalogue effectif de l'opticien : ses exclusions (users.settings) appliquées côté serveur
+            async with async_engine.connect() as conn:
+                user_row = await get_user_async(conn, for_user)
+            if not user_row: raise HTTPException(404, "Utilisateur introuvable")
+            exclusions = catalog_exclusions(user_row['settings'])
+        catalog = await get_catalog_async()
+        limit = min(limit, 5000)
+        key = ("lenses", (brand or "").upper(), type or "", limit, exclusions_key(exclusions))
+        count_key = key + ("count",)
+        def select():
+            rows = catalog.select(brand=brand, type=type, limit=limit, exclusions=exclusions)
+            catalog.payload(count_key, lambda: len(rows))
+            return rows
+        if wants_columnar(request, format):
+            response = await catalog_response_async(request, catalog, key + ("columnar",), lambda: orjson.dumps(columnar(select(), catalog.version)), COLUMNAR_MEDIA_TYPE)
+        else: response = await catalog_response_async(request, catalog, key, lambda: json.dumps(select(), separators=(",", ":")))
+        # Nombre de verres lu à chaque réponse : reste dans le LRU aussi longtemps que le corps
+        if response.status_code == 200: CATALOG_ROWS.inc(catalog.cached(count_key) or 0)
+        return response
+    except Exception as e:
+        if isinstance(e, HTTPException): raise e
+        print(f"Erreur get_lenses: {e}")
+        HANDLER_ERRORS.labels("/lenses").inc()
+        return []
+
+@app.get("/lenses/search")
+async def search_lenses(q: str = Query(..., min_length=2), brand: str = Query(None), limit: int = Query(20)):
+    """Verres dont nom, design, code commercial ou code EDI ressemblent à q (accents et fautes tolérés)."""
+    global _catalog_checked_at
+    if not engine: raise HTTPException(500, "Pas de BDD")
+    try:
+        query, brand_key, limit = normalize_string(q), up(brand) or None, max(1, min(limit, 100))
+        catalog = await get_catalog_async()
+        if lens_search_trgm:
+            sql = SEARCH_SQL.format(brand_filter="AND upper(brand) = :brand" if brand_key else "")
+            async with async_engine.begin() as conn:
+                await conn.execute(text("SELECT set_config('pg_trgm.word_similarity_threshold', :t, true)"), {"t": str(SEARCH_THRESHOLD)})
+                found = (await conn.execute(text(sql), {"q": query, "brand": brand_key, "limit": limit})).fetchall()
+            if found and found[0].version != catalog.version:
+                # Catalogue remplacé depuis ce snapshot (ids repartis de 1) : recherche sur le snapshot lui-même,
+                # et relecture de version dès la prochaine requête
+                _catalog_checked_at = 0.0
+                hits = await run_in_threadpool(catalog.search_index().search, query, brand_key, limit)
+            # Lignes servies depuis le snapshot (même format que /lenses) ; un id absent attend le prochain rechargement
+            else: hits = [(r.score, catalog.profiles[r.id].row) for r in found if r.id in catalog.profiles]
+        else:
+            hits = await run_in_threadpool(catalog.search_index().search, query, brand_key, limit)
+        return {"version": catalog.version, "query": query, "lenses": [{**row, "score": round(score, 3)} for score, row in hits]}
+    except Exception as e:
+        print(f"Erreur search_lenses: {e}")
+        raise HTTPException(500, str(e))
+
+@app.get("/lenses/facets")
+def get_lens_facets(request: Request, brand: str = Query(None), type: str = Query(None), network: str = Query("HORS_RESEAU")):
+    if not engine: raise HTTPException(500, "Pas de BDD")
+    try:
+        catalog = get_catalog()
+        key = ("facets", up(brand), type or "", up(network))
+        return catalog_response(request, catalog, key, lambda: json.dumps(catalog.facet_counts(brand=brand, type=type, network=network), separators=(",", ":")))
+    except Exception as e:
+        print(f"Erreur get_lens_facets: {e}")
+        raise HTTPException(500, str(e))
+
+@app.get("/lenses/ranked")
+def get_ranked_lenses(username: str = Query(None), network: str = Query("HORS_RESEAU"), brand: str = Query(None), type: str = Query(None),
+                      material: list[str] = Query(None), materialIndex: str = Query(None), flow: list[str] = Query(None),
+                      coating: str = Query(None), design: list[str] = Query(None), calisize: bool = Query(False),
+                      myopiaControl: bool = Query(False), limit: int = Query(50)):
+    if not engine: raise HTTPException(500, "Pas de BDD")
+    try:
+        settings = {}
+        if username:
+            with engine.connect() as conn:
+                user_row = get_user(conn, username)
+            if not user_row: raise HTTPException(404, "Utilisateur introuvable")
+            settings = user_row['settings'] or {}
+        catalog = get_catalog()
+        rows = catalog.index.get(((brand or "").strip().upper() or None, None), [])
+        filters = {"brand": brand, "type": type, "material": material, "materialIndex": materialIndex, "flow": flow,
+                   "coating": coating, "design": design, "calisize": calisize, "myopiaControl": myopiaControl}
+        total, lenses = rank_lenses([catalog.profiles[r['id']] for r in rows], network, settings, filters, limit=min(limit, 500))
+        return {"version": catalog.version, "network": network, "total": total, "lenses": lenses}
+    except Exception as e:
+        if isinstance(e, HTTPException): raise e
+        print(f"Erreur get_ranked_lenses: {e}")
+        raise HTTPException(500, str(e))
+
+IMPORT_MODES = ("replace", "diff") # replace : table reconstruite et basculée / diff : seules les lignes modifiées sont écrites
+
+def _detach_upload(upload):
+    """Fichier binaire sur le contenu de l'upload, indépendant de l'UploadFile (fermé en fin de requête).
+
+    Le fichier temporaire de Starlette est partagé via un descripteur dupliqué : pas de recopie,
+    l'import en tâche de fond le lit tant qu'il ne l'a pas fermé.
+    """
+    upload.file.seek(0)
+    return os.fdopen(os.dup(upload.file.fileno()), "rb")
+
+@app.post("/upload-catalog", status_code=202)
+def upload_catalog(file: UploadFile = File(...), mode: str = Query("replace")):
+    print(f"🚀 Upload Catalogue ({mode})...", flush=True)
     if not engine: raise HTTPException(500, "Serveur BDD déconnecté")
-    temp_file = f"/tmp/upload_{int(datetime.now().timestamp())}.xlsx"
+    if mode not in IMPORT_MODES: raise HTTPException(400, f"Mode d'import inconnu: {mode}")
+    # Un seul import à la fois (tous workers confondus) : la table lenses_staging est partagée
+    lock_conn = engine.connect()
+    if not lock_conn.execute(text("SELECT pg_try_advisory_lock(:k)"), {"k": CATALOG_IMPORT_LOCK}).scalar():
+        lock_conn.close()
+        raise HTTPException(409, "Un import catalogue est déjà en cours")
+    lock_conn.commit()
+    job = ImportJob(uuid.uuid4().hex, file.filename, mode)
+    source = None
     try:
-        with open(temp_file, "wb") as buffer: shutil.copyfileobj(file.file, buffer)
-        wb = openpyxl.load_workbook(temp_file, data_only=True, read_only=True)
-        with engine.begin() as conn:
-            conn.execute(text("ALTER TABLE lenses ADD COLUMN IF NOT EXISTS purchase_price_bonifie DECIMAL(10,2) DEFAULT 0;"))
-            conn.execute(text("ALTER TABLE lenses ADD COLUMN IF NOT EXISTS purchase_price_super_bonifie DECIMAL(10,2) DEFAULT 0;"))
-            conn.execute(text("TRUNCATE TABLE lenses RESTART IDENTITY CASCADE;"))
-        total_inserted = 0
-        with engine.connect() as conn:
-            for sheet_name in wb.sheetnames:
-                sheet = wb[sheet_name]
-                sheet_brand = sheet_name.strip().upper()
-                row_iterator = sheet.iter_rows(values_only=True)
-                header_idx, headers, current_row_idx = -1, [], 0
-                for row in row_iterator:
-                    current_row_idx += 1
-                    if current_row_idx > 30: break
-                    row_str = [str(c).upper() for c in row if c]
-                    if any(k in s for s in row_str for k in ["MODELE", "LIBELLE", "NAME"]):
-                        headers, header_idx = row, current_row_idx; break
-                if not headers: continue
-                c_nom = get_col_idx(headers, ['MODELE COMMERCIAL', 'MODELE', 'LIBELLE', 'NAME'])
-                c_marque = get_col_idx(headers, ['MARQUE', 'BRAND'])
-                c_edi = get_col_idx(headers, ['CODE EDI', 'EDI'])
-                c_code = get_col_idx(headers, ['CODE COMMERCIAL', 'COMMERCIAL_CODE'])
-                c_geo = get_col_idx(headers, ['GÉOMETRIE', 'GEOMETRIE', 'TYPE'])
-                c_design = get_col_idx(headers, ['DESIGN', 'GAMME'])
-                c_idx = get_col_idx(headers, ['INDICE', 'INDEX'])
-                c_mat = get_col_idx(headers, ['MATIERE', 'MATIÈRE', 'MATERIAL'])
-                c_coat = get_col_idx(headers, ['TRAITEMENT', 'COATING'])
-                c_flow = get_col_idx(headers, ['FLUX', 'COMMERCIAL_FLOW'])
-                c_color = get_col_idx(headers, ['COULEUR', 'COLOR'])
-                c_buy = get_col_idx(headers, ['PRIX 2*NETS', 'PRIX', 'ACHAT', 'PURCHASE_PRICE'])
-                c_buy_bonif = get_col_idx(headers, ['PRIX BONIFIE', 'ACHAT BONIFIE', 'BONIFIE'])
-                c_buy_super = get_col_idx(headers, ['PRIX SUPER BONIFIE', 'SUPER BONIFIE', 'SUPER'])
-                c_kal = get_col_idx(headers, ['KALIXIA'])
-                c_ite = get_col_idx(headers, ['ITELIS'])
-                c_cb = get_col_idx(headers, ['CARTE BLANCHE'])
-                c_sev = get_col_idx(headers, ['SEVEANE'])
-                c_sant = get_col_idx(headers, ['SANTECLAIR'])
-                if c_nom == -1: continue
-                batch, BATCH_SIZE = [], 2000 
-                for row in row_iterator:
-                    if not row[c_nom]: continue
-                    buy = clean_price(row[c_buy]) if c_buy != -1 else 0
-                    buy_bonif = clean_price(row[c_buy_bonif]) if c_buy_bonif != -1 else 0
-                    buy_super = clean_price(row[c_buy_super]) if c_buy_super != -1 else 0
-                    brand = clean_text(row[c_marque]) if c_marque != -1 else sheet_brand
-                    if not brand or brand == "None": brand = sheet_brand
-                    name = clean_text(row[c_nom])
-                    mat = clean_text(row[c_mat]) if c_mat != -1 else ""
-                    if any(x in mat.upper() for x in ['TRANS', 'GEN', 'SOLA', 'SUN']): name += f" {mat}"
-                    geo_raw = clean_text(row[c_geo]).upper() if c_geo != -1 else ""
-                    design_val = clean_text(row[c_design]) if c_design != -1 else "STANDARD"
-                    code = clean_text(row[c_code]) if c_code != -1 else ""
-                    ltype = 'UNIFOCAL'
-                    if 'DEGRESSIF' in geo_raw: ltype = 'DEGRESSIF'
-                    elif 'INTERIEUR' in geo_raw: ltype = 'PROGRESSIF_INTERIEUR'
-                    elif 'PROG' in geo_raw: ltype = 'PROGRESSIF'
-                    elif 'MULTIFOCAL' in geo_raw: ltype = 'MULTIFOCAL'
-                    full_search = (name + " " + design_val + " " + code).upper().replace(" ", "")
-                    if 'PROXEO' in full_search: ltype = 'DEGRESSIF'
-                    if 'MYPROXI' in full_search: ltype = 'PROGRESSIF_INTERIEUR'
-                    if buy <= 0: buy = clean_price(row[c_kal]) if c_kal != -1 else 0.01
-                    batch.append({
-                        "brand": brand[:100], "edi": clean_text(row[c_edi]) if c_edi != -1 else "",
-                        "code": code, "name": name, "geo": ltype, "design": design_val,
-                        "idx": clean_index(row[c_idx]) if c_idx != -1 else "1.50",
-                        "mat": mat, "coat": clean_text(row[c_coat]) if c_coat != -1 else "DURCI",
-                        "flow": clean_text(row[c_flow]) if c_flow != -1 else "FAB",
-                        "color": clean_text(row[c_color]) if c_color != -1 else "",
-                        "buy": buy, "buy_bonif": buy_bonif, "buy_super": buy_super,
-                        "selling": clean_price(row[c_kal]) if c_kal != -1 else 0,
-                        "kal": clean_price(row[c_kal]) if c_kal != -1 else 0, "ite": clean_price(row[c_ite]) if c_ite != -1 else 0,
-                        "cb": clean_price(row[c_cb]) if c_cb != -1 else 0, "sev": clean_price(row[c_sev]) if c_sev != -1 else 0,
-                        "sant": clean_price(row[c_sant]) if c_sant != -1 else 0,
-                    })
-                    if len(batch) >= BATCH_SIZE:
-                        with conn.begin():
-                            conn.execute(text("""
-                                INSERT INTO lenses (brand, edi_code, commercial_code, name, geometry, design, index_mat, material, coating, commercial_flow, color, purchase_price, purchase_price_bonifie, purchase_price_super_bonifie, selling_price, sell_kalixia, sell_itelis, sell_carteblanche, sell_seveane, sell_santeclair)
-                                VALUES (:brand, :edi, :code, :name, :geo, :design, :idx, :mat, :coat, :flow, :color, :buy, :buy_bonif, :buy_super, :selling, :kal, :ite, :cb, :sev, :sant)
-                            """), batch)
-                        total_inserted += len(batch); batch = []; gc.collect(); time.sleep(0.01)
-                if batch:
-                    with conn.begin():
-                        conn.execute(text("""
-                            INSERT INTO lenses (brand, edi_code, commercial_code, name, geometry, design, index_mat, material, coating, commercial_flow, color, purchase_price, purchase_price_bonifie, purchase_price_super_bonifie, selling_price, sell_kalixia, sell_itelis, sell_carteblanche, sell_seveane, sell_santeclair)
-                            VALUES (:brand, :edi, :code, :name, :geo, :design, :idx, :mat, :coat, :flow, :color, :buy, :buy_bonif, :buy_super, :selling, :kal, :ite, :cb, :sev, :sant)
-                        """), batch)
-                    total_inserted += len(batch); gc.collect()
-        return {"status": "success", "count": total_inserted}
+        source = _detach_upload(file)
+        job.create()
+        import_executor.submit(run_catalog_import, job, source, lock_conn)
     except Exception as e:
         print(f"❌ ERREUR: {traceback.format_exc()}", flush=True)
+        if source: source.close()
+        _release_import_lock(lock_conn)
         raise HTTPException(500, f"Erreur: {str(e)}")
+    return {"status": "accepted", "job_id": job.id}
+
+@app.get("/upload-catalog/jobs/{job_id}")
+def get_import_job(job_id: str):
+    if not engine: raise HTTPException(500, "Pas de BDD")
+    with engine.connect() as conn:
+        row = conn.execute(text("""
+            SELECT *, EXTRACT(EPOCH FROM (COALESCE(finished_at, CURRENT_TIMESTAMP) - COALESCE(started_at, created_at))) AS elapsed
+            FROM catalog_import_jobs WHERE id = :id
+        """), {"id": job_id}).fetchone()
+    if not row: raise HTTPException(404, "Import introuvable")
+    progress = row.progress or {}
+    return {
+        "job_id": row.id, "status": row.status, "filename": row.filename, "error": row.error,
+        "created_at": row.created_at, "elapsed": round(float(row.elapsed or 0), 2),
+        "phase": progress.get("phase"), "mode": progress.get("mode", "replace"), "count": progress.get("count", 0), "version": progress.get("version"),
+        "changes": progress.get("changes"),
+        "parsed": progress.get("parsed", 0), "inserted": progress.get("inserted", 0),
+        "sheets": [{"sheet": name, **p} for name, p in (progress.get("sheets") or {}).items()]
+    }
+
+def run_catalog_import(job, source, lock_conn):
+    """Import complet d'un classeur dans lenses (exécuté par import_executor)."""
+    job.start()
+    started = time.perf_counter()
+    try:
+        total_inserted = 0
+        # Chargement dans lenses_staging : le catalogue en service reste intact jusqu'à la bascule.
+        # Les feuilles sont analysées en parallèle (importer.py), le COPY reste unique et séquentiel.
+        with engine.begin() as conn:
+            create_staging_table(conn, "lenses")
+            for sheet in iter_parsed_sheets(source, "upload"):
+                progress = job.sheet(sheet.brand)
+                progress["read"], progress["parsed"] = sheet.read, len(sheet.rows)
+                progress["inserted"] = copy_rows(conn, "lenses_staging", LENS_COLUMNS, sheet.rows)
+                total_inserted += progress["inserted"]; job.save(force=True)
+                print(f"   ✅ {sheet.brand} : {total_inserted} verres chargés", flush=True)
+            if job.mode == "replace":
+                job.phase = "indexing"; job.save(force=True)
+                build_staging_indexes(conn, "lenses")
+        if job.mode == "diff":
+            # Comparaison clé métier + hash de contenu : les id des verres inchangés ou modifiés sont conservés
+            job.phase = "merging"; job.save(force=True)
+            with engine.begin() as conn:
+                conn.execute(text("ANALYZE lenses_staging"))
+                job.changes = upsert_from_staging(conn, "lenses", LENS_COLUMNS)
+                drop_staging_table(conn, "lenses")
+                changed = job.changes["inserted"] + job.changes["updated"] + job.changes["deleted"]
+                # Rien n'a bougé : même version, les caches (ETag) restent valides
+                version = bump_catalog_version(conn) if changed else conn.execute(text("SELECT version FROM catalog_meta WHERE id = 1")).scalar()
+            print(f"   🔁 Diff : {job.changes}", flush=True)
+            if changed: reload_catalog(version)
+        else:
+            # Bascule atomique + nouvelle version dans la même transaction courte
+            job.phase = "swapping"; job.save(force=True)
+            with engine.begin() as conn:
+                swap_staging_table(conn, "lenses")
+                version = bump_catalog_version(conn)
+            reload_catalog(version)
+        job.finish(total_inserted, version)
+        record_import("catalog", total_inserted, time.perf_counter() - started)
+        print(f"✅ Import {job.id} : {total_inserted} verres (catalogue v{version})", flush=True)
+    except Exception as e:
+        print(f"❌ ERREUR: {traceback.format_exc()}", flush=True)
+        try:
+            with engine.begin() as conn: drop_staging_table(conn, "lenses")
+        except Exception as drop_error: print(f"⚠️ Nettoyage lenses_staging: {drop_error}")
+        job.fail(str(e))
     finally:
-        if wb: wb.close()
-        if os.path.exists(temp_file): os.remove(temp_file)
+        source.close()
+        _release_import_lock(lock_conn)
         gc.collect()
\ No newline at end of file
@@ -0,0 +1,76 @@
+"""Métriques Prometheus de l'API (exposées par GET /metrics).
+
+Par processus ; avec plusieurs workers uvicorn, définir PROMETHEUS_MULTIPROC_DIR (répertoire vide
+au lancement) pour que /metrics agrège tous les workers.
+"""
+import os
+import time
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+
+# Routes suivies individuellement ; les autres sont regroupées sous "autre"
+TRACKED_ROUTES = ("/auth/login", "/lenses", "/lenses/search", "/lenses/facets", "/lenses/ranked", "/offers", "/offers/batch",
+                  "/offers/identities", "/admin/stats", "/upload-catalog", "/upload-users")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+HTTP_LATENCY = Histogram("podium_http_request_duration_seconds", "Durée des requêtes HTTP", ["route", "method"], buckets=LATENCY_BUCKETS)
+HTTP_REQUESTS = Counter("podium_http_requests_total", "Requêtes HTTP par statut", ["route", "method", "status"])
+HANDLER_ERRORS = Counter("podium_handler_errors_total", "Erreurs interceptées par une route qui répond quand même (liste ou objet vide)", ["route"])
+
+POOL_CHECKOUT = Histogram("podium_db_pool_checkout_seconds", "Attente d'une connexion du pool SQLAlchemy", ["engine"],
+                          buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30))
+POOL_IN_USE = Gauge("podium_db_pool_in_use", "Connexions empruntées", ["engine"], multiprocess_mode="livesum")
+POOL_OVERFLOW = Gauge("podium_db_pool_overflow", "Connexions au-delà de pool_size (négatif : pool pas encore rempli)", ["engine"], multiprocess_mode="livesum")
+POOL_SIZE = Gauge("podium_db_pool_size", "Taille configurée du pool", ["engine"], multiprocess_mode="livesum")
+
+CATALOG_ROWS = Counter("podium_catalog_rows_served_total", "Verres envoyés par /lenses (réponses 304 exclues)")
+CRYPTO_SECONDS = Histogram("podium_fernet_seconds", "Chiffrement / déchiffrement Fernet des identités clients", ["op"],
+                           buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05))
+IMPORT_ROWS = Counter("podium_import_rows_total", "Lignes importées", ["kind"])
+IMPORT_SECONDS = Histogram("podium_import_duration_seconds", "Durée des imports", ["kind"], buckets=(1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+IMPORT_ROWS_PER_SECOND = Gauge("podium_import_rows_per_second", "Débit du dernier import", ["kind"], multiprocess_mode="mostrecent")
+
+class TimedQueuePool(QueuePool):
+    """QueuePool qui mesure l'attente de chaque emprunt de connexion."""
+    metrics_engine = "sync"
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try: return super()._do_get()
+        finally: POOL_CHECKOUT.labels(self.metrics_engine).observe(time.perf_counter() - start)
+
+class TimedAsyncPool(AsyncAdaptedQueuePool):
+    metrics_engine = "async"
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try: return super()._do_get()
+        finally: POOL_CHECKOUT.labels(self.metrics_engine).observe(time.perf_counter() - start)
+
+def route_label(request):
+    route = request.scope.get("route")
+    path = getattr(route, "path", None)
+    return path if path in TRACKED_ROUTES else "autre"
+
+def observe_pools(engines):
+    # Jauges relevées au moment du scrape
+    for name, engine in engines.items():
+        if engine is None: continue
+        pool = engine.sync_engine.pool if hasattr(engine, "sync_engine") else engine.pool
+        if not isinstance(pool, QueuePool): continue
+        POOL_IN_USE.labels(name).set(pool.checkedout())
+        POOL_OVERFLOW.labels(name).set(pool.overflow())
+        POOL_SIZE.labels(name).set(pool.size())
+
+def record_import(kind, rows, seconds):
+    IMPORT_ROWS.labels(kind).inc(rows)
+    IMPORT_SECONDS.labels(kind).observe(seconds)
+    if seconds > 0: IMPORT_ROWS_PER_SECOND.labels(kind).set(rows / seconds)
+
+def render():
+    """(corps, type MIME) du format texte Prometheus."""
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,182 @@
+import os
+import sys
+import time
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, text
+from stats import ROLLUP_DDL, rebuild_offer_stats
+from search import SEARCH_KEY_DDL, SEARCH_INDEX_DDL
+
+# Migrations numérotées du schéma, appliquées une seule fois chacune (table schema_migrations).
+# Usage : python migrations.py            -> applique les migrations en attente
+#         python migrations.py --status   -> version en base / version attendue
+# Au démarrage, main.py ne lit que la version ; MIGRATE_ON_STARTUP=1 (défaut) applique le retard éventuel.
+# Ne jamais modifier une migration déjà déployée : en ajouter une nouvelle en fin de liste.
+
+MIGRATION_LOCK = 7204520 # clé pg_advisory_lock (un seul worker / CLI migre à la fois)
+
+def _seed_admin(conn):
+    if conn.execute(text("SELECT COUNT(*) FROM users")).scalar() == 0:
+        print("⚠️ Base utilisateurs vide : Création de l'admin par défaut...")
+        conn.execute(text("""
+            INSERT INTO users (username, shop_name, password, email, role, is_first_login)
+            VALUES ('admin', 'ADMINISTRATION', 'admin', 'admin@podium.optique', 'admin', FALSE)
+        """))
+        print("✅ Utilisateur 'admin' créé (Mdp: admin)")
+
+def _init_rollups(conn):
+    if not conn.execute(text("SELECT EXISTS (SELECT 1 FROM offer_stats_rollup)")).scalar() and conn.execute(text("SELECT EXISTS (SELECT 1 FROM client_offers WHERE tags IS NOT NULL)")).scalar():
+        print(f"📊 Cumuls statistiques initialisés ({rebuild_offer_stats(conn)} dossiers)")
+
+def _lens_search_index(conn):
+    # L'extension peut être refusée (droits, base locale) : /lenses/search cherche alors en mémoire
+    try:
+        with conn.begin_nested():
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm;"))
+            conn.execute(text(SEARCH_INDEX_DDL))
+    except Exception as e: print(f"Info pg_trgm (recherche en mémoire): {e}")
+
+# (numéro, description, étapes) ; une étape est une requête SQL ou une fonction(conn)
+MIGRATIONS = [
+    (1, "utilisateurs", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            username VARCHAR(100) PRIMARY KEY,
+            shop_name TEXT,
+            password TEXT,
+            email TEXT,
+            role VARCHAR(50) DEFAULT 'user',
+            is_first_login BOOLEAN DEFAULT TRUE,
+            settings JSONB -- Stockage des préférences (Filtres, Thème, etc.)
+        );
+        """,
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS settings JSONB;",
+        # Login insensible à la casse (WHERE LOWER(username) = ...)
+        "CREATE INDEX IF NOT EXISTS idx_users_lower_username ON users (LOWER(username));",
+        _seed_admin,
+    ]),
+    (2, "dossiers clients", [
+        """
+        CREATE TABLE IF NOT EXISTS client_offers (
+            id SERIAL PRIMARY KEY,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            username VARCHAR(100), -- Identifiant de l'adhérent
+            encrypted_identity TEXT,
+            lens_details JSONB,
+            financials JSONB,
+            tags JSONB -- Stockage structuré pour stats
+        );
+        """,
+        "ALTER TABLE client_offers ADD COLUMN IF NOT EXISTS username VARCHAR(100);",
+        "ALTER TABLE client_offers ADD COLUMN IF NOT EXISTS tags JSONB;",
+        # Index alignés sur les requêtes (vérifiés par explain_check.py)
+        "CREATE INDEX IF NOT EXISTS idx_offers_tag_geometry ON client_offers ((tags->>'geometry'));",
+        "CREATE INDEX IF NOT EXISTS idx_offers_user_created ON client_offers (username, created_at DESC, id DESC);",
+        "CREATE INDEX IF NOT EXISTS idx_offers_created ON client_offers (created_at DESC, id DESC);",
+        # Index des anciens GROUP BY de /admin/stats (remplacés par les cumuls)
+        "DROP INDEX IF EXISTS idx_offers_tag_design;",
+        "DROP INDEX IF EXISTS idx_offers_user_geo_design;",
+    ]),
+    (3, "cumuls statistiques", [*ROLLUP_DDL, _init_rollups]),
+    (4, "catalogue", [
+        """
+        CREATE TABLE IF NOT EXISTS lenses (
+            id SERIAL PRIMARY KEY, brand TEXT, name TEXT, commercial_code TEXT,
+            geometry TEXT, design TEXT, index_mat TEXT, material TEXT, coating TEXT,
+            commercial_flow TEXT, color TEXT,
+            purchase_price DECIMAL(10,2),
+            purchase_price_bonifie DECIMAL(10,2) DEFAULT 0,
+            purchase_price_super_bonifie DECIMAL(10,2) DEFAULT 0,
+            selling_price DECIMAL(10,2),
+            sell_kalixia DECIMAL(10,2), sell_itelis DECIMAL(10,2),
+            sell_carteblanche DECIMAL(10,2), sell_seveane DECIMAL(10,2),
+            sell_santeclair DECIMAL(10,2),
+            edi_code TEXT
+        );
+        """,
+        "ALTER TABLE lenses ADD COLUMN IF NOT EXISTS purchase_price_bonifie DECIMAL(10,2) DEFAULT 0;",
+        "ALTER TABLE lenses ADD COLUMN IF NOT EXISTS purchase_price_super_bonifie DECIMAL(10,2) DEFAULT 0;",
+        "ALTER TABLE lenses ADD COLUMN IF NOT EXISTS edi_code TEXT;",
+        # Version du catalogue (invalidation des caches mémoire)
+        """
+        CREATE TABLE IF NOT EXISTS catalog_meta (
+            id INT PRIMARY KEY DEFAULT 1,
+            version INT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        "INSERT INTO catalog_meta (id, version) VALUES (1, 0) ON CONFLICT (id) DO NOTHING;",
+        # Suivi des imports catalogue en tâche de fond
+        """
+        CREATE TABLE IF NOT EXISTS catalog_import_jobs (
+            id VARCHAR(32) PRIMARY KEY,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            filename TEXT,
+            status VARCHAR(20) DEFAULT 'queued', -- queued / running / success / error
+            progress JSONB,
+            error TEXT
+        );
+        """,
+    ]),
+    (5, "recherche verres (pg_trgm)", [SEARCH_KEY_DDL, _lens_search_index]),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+SCHEMA_MIGRATIONS_DDL = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INT PRIMARY KEY,
+        name TEXT,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+
+def schema_version(conn):
+    """Dernière migration appliquée (0 si la base n'a jamais été migrée)."""
+    if conn.execute(text("SELECT to_regclass('schema_migrations')")).scalar() is None: return 0
+    return conn.execute(text("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")).scalar()
+
+def migrate(engine):
+    """Applique les migrations en attente, chacune dans sa transaction. Renvoie la version finale."""
+    with engine.connect() as conn:
+        # Verrou de session : les autres workers attendent puis ne trouvent plus rien à appliquer
+        conn.execute(text("SELECT pg_advisory_lock(:k)"), {"k": MIGRATION_LOCK}); conn.commit()
+        try:
+            with conn.begin():
+                conn.execute(text(SCHEMA_MIGRATIONS_DDL))
+                applied = {r[0] for r in conn.execute(text("SELECT version FROM schema_migrations"))}
+            for version, name, steps in MIGRATIONS:
+                if version in applied: continue
+                start = time.time()
+                with conn.begin():
+                    for step in steps:
+                        if callable(step): step(conn)
+                        else: conn.execute(text(step))
+                    conn.execute(text("INSERT INTO schema_migrations (version, name) VALUES (:v, :n)"), {"v": version, "n": name})
+                print(f"🧱 Migration {version:03d} ({name}) appliquée en {round(time.time() - start, 2)} s", flush=True)
+            return LATEST_VERSION
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": MIGRATION_LOCK}); conn.commit()
+
+if __name__ == "__main__":
+    load_dotenv()
+    DATABASE_URL = os.getenv("DATABASE_URL")
+    if not DATABASE_URL:
+        print("❌ Erreur : DATABASE_URL manquant dans le fichier .env")
+        sys.exit(1)
+    if DATABASE_URL.startswith("postgres://"):
+        DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
+    if "sslmode" not in DATABASE_URL:
+        separator = "&" if "?" in DATABASE_URL else "?"
+        DATABASE_URL += f"{separator}sslmode=require"
+    engine = create_engine(DATABASE_URL)
+    with engine.connect() as conn: current = schema_version(conn)
+    if "--status" in sys.argv[1:]:
+        print(f"🧱 Schéma v{current} (attendu : v{LATEST_VERSION})")
+        sys.exit(0 if current >= LATEST_VERSION else 1)
+    try:
+        if current >= LATEST_VERSION: print(f"✅ Schéma déjà à jour (v{current})")
+        else: print(f"✅ Schéma migré : v{current} -> v{migrate(engine)}")
+    except Exception as e:
+        print(f"❌ ERREUR MIGRATION : {e}")
+        sys.exit(1)
@@ -0,0 +1,159 @@
+"""Moteur de prix et de classement par marge (miroir serveur de la logique de App.jsx)."""
+import math
+
+TVA = 1.2
+
+NETWORK_PRICE_COLUMNS = {
+    'KALIXIA': 'sell_kalixia', 'ITELIS': 'sell_itelis', 'CARTEBLANCHE': 'sell_carteblanche',
+    'SEVEANE': 'sell_seveane', 'SANTECLAIR': 'sell_santeclair'
+}
+CALISIZE_NETWORK_PRICES = {'KALIXIA': 12, 'CARTEBLANCHE': 20, 'ITELIS': 10, 'SEVEANE': 10, 'SANTECLAIR': 10, 'HORS_RESEAU': 0}
+
+DEFAULT_PRICING_CONFIG = {"x": 2.5, "b": 20}
+DEFAULT_PRICING = {
+    "uniStock": {"x": 2.5, "b": 20},
+    "uniFab": {"x": 3.0, "b": 30},
+    "prog": {"x": 3.2, "b": 50},
+    "degressif": {"x": 3.0, "b": 40},
+    "interieur": {"x": 3.0, "b": 40},
+    "multifocal": {"x": 3.0, "b": 40},
+    "calisize": {"price": 10}
+}
+DEFAULT_PER_LENS_CONFIG = {"disabledAttributes": {"designs": [], "indices": [], "coatings": []}, "prices": {}}
+
+def up(value): return "" if value is None else str(value).upper().strip()
+
+def to_float(value):
+    try: return float(value or 0)
+    except (TypeError, ValueError): return 0.0
+
+def round_half_up(value): return math.floor(value + 0.5) # Math.round() JS
+
+def merge_settings(settings):
+    """Fusion des préférences utilisateur avec les valeurs par défaut (comme handleLogin côté front)."""
+    s = settings if isinstance(settings, dict) else {}
+    merged = {
+        "pricingMode": s.get("pricingMode") or "linear",
+        "pricing": {**DEFAULT_PRICING, **(s.get("pricing") or {})},
+        "perLensConfig": {**DEFAULT_PER_LENS_CONFIG, **(s.get("perLensConfig") or {})},
+    }
+    for k in ("disabledBrands", "disabledNetworks", "disabledDesigns", "disabledMaterials"):
+        merged[k] = s[k] if isinstance(s.get(k), list) else []
+    return merged
+
+def catalog_exclusions(settings):
+    """(marques, designs, matières) masqués par l'utilisateur, comparés comme cleanText côté front."""
+    s = merge_settings(settings)
+    return tuple(frozenset(up(v) for v in s[k] if v is not None) for k in ("disabledBrands", "disabledDesigns", "disabledMaterials"))
+
+class LensProfile:
+    """Colonnes dérivées d'un verre, calculées une seule fois par version du catalogue."""
+    __slots__ = ("row", "brand", "geometry", "design", "material", "coating", "name", "index",
+                 "purchase", "rule", "is_stock", "lens_key", "sell")
+
+    def __init__(self, row):
+        self.row = row
+        self.brand = up(row.get('brand'))
+        self.geometry = up(row.get('type') or row.get('geometry'))
+        self.design = up(row.get('design'))
+        self.material = up(row.get('material'))
+        self.coating = up(row.get('coating'))
+        self.name = up(row.get('name'))
+        try: self.index = float(str(row.get('index_mat')).replace(',', '.')) if row.get('index_mat') else None
+        except ValueError: self.index = None
+        self.purchase = to_float(row.get('purchase_price'))
+        flow = up(row.get('commercial_flow'))
+        # Filtre RX / STOCK du front : ' ST' seulement ; la règle de prix accepte aussi '_ST'
+        self.is_stock = 'STOCK' in flow or ' ST' in self.name
+        if 'UNIFOCAL' in self.geometry: self.rule = 'uniStock' if (self.is_stock or '_ST' in self.name) else 'uniFab'
+        elif 'DEGRESSIF' in self.geometry: self.rule = 'degressif'
+        elif 'INTERIEUR' in self.geometry: self.rule = 'interieur'
+        elif 'MULTIFOCAL' in self.geometry: self.rule = 'multifocal'
+        else: self.rule = 'prog'
+        self.lens_key = f"{up(row.get('type'))}_{self.design}_{up(row.get('index_mat'))}_{self.coating}"
+        self.sell = {net: to_float(row.get(col)) for net, col in NETWORK_PRICE_COLUMNS.items()}
+
+def network_allows_brand(network, brand):
+    """Restrictions marque/réseau appliquées par le front quand aucune marque n'est choisie."""
+    if network == 'SANTECLAIR': return brand in ('SEIKO', 'ZEISS')
+    if network != 'HORS_RESEAU': return brand not in ('ORUS', 'ZEISS')
+    return True
+
+def calisize_addon(network, settings, enabled):
+    if not enabled: return 0
+    if network == 'HORS_RESEAU': return (settings["pricing"].get("calisize") or {}).get("price") or 10
+    return CALISIZE_NETWORK_PRICES.get(network, 0)
+
+def _pre_filter(profiles, network, s, f):
+    disabled_designs = set(s["disabledDesigns"])
+    disabled_materials = set(s["disabledMaterials"])
+    brand = up(f.get("brand"))
+    if brand: allowed = lambda p: p.brand == brand
+    else:
+        disabled_brands = set(s["disabledBrands"])
+        allowed = lambda p: network_allows_brand(network, p.brand) and p.brand not in disabled_brands
+    target = up(f.get("type"))
+    if not target: geo_ok = lambda p: True
+    elif target == 'PROGRESSIF_INTERIEUR': geo_ok = lambda p: 'INTERIEUR' in p.geometry
+    else: geo_ok = lambda p: p.geometry == target
+    return [p for p in profiles if p.design not in disabled_designs and p.material not in disabled_materials and allowed(p) and geo_ok(p)]
+
+def _price(profiles, network, s, addon):
+    """Retourne [(marge HT, prix de vente, profil)] triée par marge décroissante (tri stable)."""
+    priced = []
+    if network == 'HORS_RESEAU':
+        if s["pricingMode"] == 'per_lens':
+            config = s["perLensConfig"]
+            disabled = config.get("disabledAttributes") or {}
+            d_designs, d_indices, d_coatings = (set(disabled.get(k) or []) for k in ("designs", "indices", "coatings"))
+            prices = config.get("prices") or {}
+            for p in profiles:
+                r = p.row
+                if r.get('design') in d_designs or r.get('index_mat') in d_indices or r.get('coating') in d_coatings: continue
+                manual = to_float(prices.get(p.lens_key))
+                if manual <= 0: continue
+                selling = manual + addon
+                priced.append((selling / TVA - p.purchase, selling, p))
+        else:
+            rules = s["pricing"]
+            for p in profiles:
+                rule = rules.get(p.rule) or DEFAULT_PRICING_CONFIG
+                selling = p.purchase * to_float(rule.get("x")) + to_float(rule.get("b")) + addon
+                priced.append((selling / TVA - p.purchase, round_half_up(selling), p))
+    else:
+        for p in profiles:
+            selling = p.sell.get(network, 0.0)
+            if selling <= 0: continue
+            selling += addon
+            priced.append((selling / TVA - p.purchase, selling, p))
+    priced.sort(key=lambda t: t[0], reverse=True)
+    return priced
+
+def rank_lenses(profiles, network, settings, filters, limit=50):
+    """Applique les filtres de App.jsx, calcule prix et marge, et renvoie le top N par marge.
+
+    profiles doit être dans l'ordre du catalogue (prix d'achat croissant) pour que les
+    égalités de marge sortent dans le même ordre que côté front.
+    """
+    s = merge_settings(settings)
+    f = filters or {}
+    network = up(network) or 'HORS_RESEAU'
+    addon = calisize_addon(network, s, f.get("calisize"))
+    priced = _price(_pre_filter(profiles, network, s, f), network, s, addon)
+
+    materials = set(f.get("material") or [])
+    if materials: priced = [t for t in priced if t[2].material in materials]
+    if f.get("materialIndex"):
+        target = to_float(str(f["materialIndex"]).replace(',', '.'))
+        priced = [t for t in priced if t[2].index is not None and abs(t[2].index - target) < 0.01]
+    flows = set(f.get("flow") or [])
+    if f.get("type") == 'UNIFOCAL' and flows:
+        priced = [t for t in priced if ('STOCK' in flows and t[2].is_stock) or ('FAB' in flows and not t[2].is_stock)]
+    if f.get("coating"):
+        coating = up(f["coating"])
+        priced = [t for t in priced if t[2].coating == coating]
+    if f.get("myopiaControl"): priced = [t for t in priced if 'MIYO' in t[2].name]
+    designs = set(f.get("design") or [])
+    if designs: priced = [t for t in priced if t[2].design in designs]
+
+    return len(priced), [{**p.row, "sellingPrice": selling, "margin": margin} for margin, selling, p in priced[:max(limit, 0)]]
@@ -0,0 +1,35 @@
+import os
+import sys
+import time
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, text
+from stats import ROLLUP_DDL, rebuild_offer_stats
+
+# 1. Configuration
+load_dotenv()
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+if not DATABASE_URL:
+    print("❌ Erreur : DATABASE_URL manquant dans le fichier .env")
+    sys.exit(1)
+
+if DATABASE_URL.startswith("postgres://"):
+    DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
+if "sslmode" not in DATABASE_URL:
+    separator = "&" if "?" in DATABASE_URL else "?"
+    DATABASE_URL += f"{separator}sslmode=require"
+
+def rebuild_stats():
+    engine = create_engine(DATABASE_URL, echo=False)
+    print("📊 Reconstruction des cumuls statistiques depuis 'client_offers'...")
+    start_time = time.time()
+    try:
+        with engine.begin() as conn:
+            for ddl in ROLLUP_DDL: conn.execute(text(ddl))
+            count = rebuild_offer_stats(conn)
+        print(f"✅ {count} dossiers agrégés en {round(time.time() - start_time, 2)} secondes.")
+    except Exception as e:
+        print(f"❌ ERREUR CRITIQUE : {e}")
+
+if __name__ == "__main__":
+    rebuild_stats()
@@ -0,0 +1,64 @@
+"""Recherche de verres tolérante aux fautes sur nom, design et codes (pg_trgm, sans accents).
+
+La clé de recherche reprend normalize_string (majuscules, accents retirés) : fonction SQL immuable
+lens_search_key(), indexée en GIN gin_trgm_ops. Sans l'extension pg_trgm (base locale, droits
+insuffisants), la même recherche est faite sur le snapshot mémoire du catalogue.
+"""
+import os
+import re
+from importer import ACCENTED, UNACCENTED, normalize_string
+
+SEARCH_FIELDS = ("name", "design", "commercial_code", "edi_code")
+# Seuil de word_similarity (pg_trgm : 0.6 par défaut) en dessous duquel un verre n'est pas proposé
+SEARCH_THRESHOLD = float(os.getenv("LENS_SEARCH_THRESHOLD", "0.5"))
+
+# upper() ne traite les minuscules accentuées que selon la collation : on les traduit aussi
+SEARCH_KEY_DDL = f"""
+    CREATE OR REPLACE FUNCTION lens_search_key(name TEXT, design TEXT, commercial_code TEXT, edi_code TEXT)
+    RETURNS TEXT LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+        SELECT translate(upper(coalesce(name, '') || ' ' || coalesce(design, '') || ' ' || coalesce(commercial_code, '') || ' ' || coalesce(edi_code, '')),
+                         '{ACCENTED}{ACCENTED.lower()}', '{UNACCENTED}{UNACCENTED}')
+    $$;
+"""
+SEARCH_KEY_SQL = "lens_search_key(name, design, commercial_code, edi_code)"
+SEARCH_INDEX_DDL = f"CREATE INDEX IF NOT EXISTS idx_lenses_search_trgm ON lenses USING gin ({SEARCH_KEY_SQL} gin_trgm_ops);"
+
+# version lue dans la même requête (même instantané que les ids) : les ids ne valent que pour ce catalogue
+SEARCH_SQL = f"""
+    SELECT id, word_similarity(:q, {SEARCH_KEY_SQL}) AS score, (SELECT version FROM catalog_meta WHERE id = 1) AS version
+    FROM lenses
+    WHERE :q <% {SEARCH_KEY_SQL} {{brand_filter}}
+    ORDER BY score DESC, purchase_price, id
+    LIMIT :limit
+"""
+
+def search_key(row):
+    return normalize_string(" ".join(str(row.get(f) or "") for f in SEARCH_FIELDS))
+
+# --- Repli mémoire : trigrammes calculés comme pg_trgm (mots alphanumériques, bordés d'espaces) ---
+_WORD_RE = re.compile(r"[^\W_]+")
+
+def trigrams(value):
+    grams = set()
+    for word in _WORD_RE.findall(value.lower()):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+class TrigramIndex:
+    """Trigrammes de la clé de recherche de chaque verre d'un snapshot."""
+    def __init__(self, rows):
+        self.entries = [(r, trigrams(search_key(r))) for r in rows]
+
+    def search(self, query, brand=None, limit=20, threshold=SEARCH_THRESHOLD):
+        # Part des trigrammes de la requête présents dans le verre : approximation de word_similarity
+        wanted = trigrams(normalize_string(query))
+        if not wanted: return []
+        hits = []
+        for row, grams in self.entries:
+            if brand and (row['brand'] or '').upper() != brand: continue
+            score = len(wanted & grams) / len(wanted)
+            if score >= threshold: hits.append((score, row))
+        # Lignes déjà triées par prix d'achat : le tri stable garde cet ordre à score égal
+        hits.sort(key=lambda h: -h[0])
+        return hits[:limit]
@@ -0,0 +1,200 @@
+"""Statistiques des dossiers clients : cumuls incrémentaux (offer_stats_rollup / offer_top_rollup)."""
+import json
+from sqlalchemy import text
+
+STATS_CATEGORIES = ["network", "geometry", "design", "index", "material", "coating", "commercial_flow"]
+TOP_GEOMETRIES = ["UNIFOCAL", "PROGRESSIF"]
+NUMERIC_RE = r"^\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*$"
+
+ROLLUP_DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS offer_stats_rollup (
+        username VARCHAR(100) NOT NULL,
+        category VARCHAR(50) NOT NULL, -- '*' pour le total général
+        value TEXT NOT NULL,
+        volume BIGINT NOT NULL DEFAULT 0,
+        revenue NUMERIC NOT NULL DEFAULT 0,
+        PRIMARY KEY (username, category, value)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS offer_top_rollup (
+        username VARCHAR(100) NOT NULL,
+        geometry VARCHAR(20) NOT NULL, -- UNIFOCAL / PROGRESSIF
+        design TEXT NOT NULL,
+        volume BIGINT NOT NULL DEFAULT 0,
+        revenue NUMERIC NOT NULL DEFAULT 0,
+        margin NUMERIC NOT NULL DEFAULT 0,
+        first_id INT, -- départage des égalités (première offre rencontrée)
+        PRIMARY KEY (username, geometry, design)
+    );
+    """,
+]
+
+# --- Calcul SQL (reconstruction complète) ---
+# Une valeur non numérique annule prix ET marge de l'offre (comme l'ancien try/except Python).
+def _json_num_ok(expr): return f"({expr} IS NULL OR jsonb_typeof({expr}) = 'number' OR (jsonb_typeof({expr}) = 'string' AND {expr} #>> '{{}}' ~ :num_re))"
+def _json_num(expr): return f"COALESCE({expr} #>> '{{}}', '0')::float8"
+
+OFFERS_CTE = f"""
+    WITH o AS (
+        SELECT id, COALESCE(username, '') AS username, tags,
+               CASE WHEN ok THEN {_json_num("financials->'total'")} ELSE 0 END AS price,
+               CASE WHEN ok THEN ({_json_num("lens_details->'sellingPrice'")} - {_json_num("lens_details->'purchase_price'")}) * 2 ELSE 0 END AS margin
+        FROM client_offers
+        CROSS JOIN LATERAL (SELECT financials IS NOT NULL AND lens_details IS NOT NULL
+            AND {_json_num_ok("financials->'total'")}
+            AND {_json_num_ok("lens_details->'sellingPrice'")}
+            AND {_json_num_ok("lens_details->'purchase_price'")} AS ok) v
+        WHERE tags IS NOT NULL AND tags NOT IN ('{{}}'::jsonb, 'null'::jsonb)
+    ), t AS (
+        SELECT o.*,
+               CASE WHEN UPPER(COALESCE(tags->>'geometry', '')) LIKE '%UNIFOCAL%' THEN 'UNIFOCAL'
+                    WHEN UPPER(COALESCE(tags->>'geometry', '')) ~ '(PROGRESSIF|INTERIEUR)' THEN 'PROGRESSIF' END AS top_geo,
+               CASE WHEN tags ? 'design' THEN COALESCE(tags->>'design', 'None') ELSE 'INCONNU' END AS top_design
+        FROM o
+    )
+"""
+
+def rebuild_offer_stats(conn):
+    """Vide et recalcule les cumuls depuis client_offers (à appeler dans une transaction)."""
+    conn.execute(text("LOCK TABLE client_offers IN SHARE MODE"))
+    conn.execute(text("DELETE FROM offer_stats_rollup"))
+    conn.execute(text("DELETE FROM offer_top_rollup"))
+    params = {"num_re": NUMERIC_RE, "cats": STATS_CATEGORIES}
+    conn.execute(text(OFFERS_CTE + """
+        INSERT INTO offer_stats_rollup (username, category, value, volume, revenue)
+        SELECT username, c.cat,
+               CASE WHEN COALESCE(tags->c.cat, 'null') IN ('null', 'false', '0', '""', '[]', '{}') THEN 'N/A' ELSE tags->>c.cat END,
+               COUNT(*), SUM(price)
+        FROM t CROSS JOIN unnest(CAST(:cats AS text[])) AS c(cat)
+        GROUP BY 1, 2, 3
+        UNION ALL
+        SELECT username, '*', '*', COUNT(*), SUM(price) FROM t GROUP BY 1
+    """), params)
+    conn.execute(text(OFFERS_CTE + """
+        INSERT INTO offer_top_rollup (username, geometry, design, volume, revenue, margin, first_id)
+        SELECT username, top_geo, top_design, COUNT(*), SUM(price), SUM(margin), MIN(id)
+        FROM t WHERE top_geo IS NOT NULL
+        GROUP BY 1, 2, 3
+    """), params)
+    return conn.execute(text("SELECT COALESCE(SUM(volume), 0) FROM offer_stats_rollup WHERE category = '*'")).scalar()
+
+# --- Mise à jour incrémentale (même transaction que l'INSERT / DELETE) ---
+def _tag_text(value):
+    # Même rendu que l'opérateur SQL ->>
+    if isinstance(value, str): return value
+    if isinstance(value, bool): return "true" if value else "false"
+    return json.dumps(value)
+
+def offer_contribution(tags, lens_details, financials):
+    """Part d'une offre dans les cumuls, ou None si l'offre n'entre pas dans les statistiques."""
+    if not tags or not isinstance(tags, dict): return None
+    try:
+        price = float(financials.get('total', 0))
+        margin = (float(lens_details.get('sellingPrice', 0)) - float(lens_details.get('purchase_price', 0))) * 2
+    except: price = 0.0; margin = 0.0
+    values = []
+    for cat in STATS_CATEGORIES:
+        val = tags.get(cat)
+        values.append((cat, _tag_text(val) if val else "N/A")) # 0 / False / "" -> "N/A", comme avant les cumuls
+    geo_raw = str(tags.get('geometry', '')).upper()
+    top_geo = None
+    if 'UNIFOCAL' in geo_raw: top_geo = "UNIFOCAL"
+    elif 'PROGRESSIF' in geo_raw or 'INTERIEUR' in geo_raw: top_geo = "PROGRESSIF"
+    design = tags.get('design', 'INCONNU')
+    return values, price, margin, top_geo, "None" if design is None else _tag_text(design)
+
+def apply_offer_stats(conn, offer_id, username, tags, lens_details, financials, sign=1):
+    """Ajoute (sign=1) ou retire (sign=-1) une offre des cumuls."""
+    contrib = offer_contribution(tags, lens_details, financials)
+    if contrib is None: return
+    values, price, margin, top_geo, design = contrib
+    username = username or ''
+    # Lignes triées : ordre de verrouillage stable entre transactions concurrentes
+    rows = sorted([("*", "*")] + values)
+    conn.execute(text("""
+        INSERT INTO offer_stats_rollup (username, category, value, volume, revenue) VALUES (:u, :c, :v, :n, :p)
+        ON CONFLICT (username, category, value) DO UPDATE SET
+            volume = offer_stats_rollup.volume + EXCLUDED.volume,
+            revenue = offer_stats_rollup.revenue + EXCLUDED.revenue
+    """), [{"u": username, "c": c, "v": v, "n": sign, "p": sign * price} for c, v in rows])
+    if top_geo:
+        conn.execute(text("""
+            INSERT INTO offer_top_rollup (username, geometry, design, volume, revenue, margin, first_id) VALUES (:u, :g, :d, :n, :p, :m, :id)
+            ON CONFLICT (username, geometry, design) DO UPDATE SET
+                volume = offer_top_rollup.volume + EXCLUDED.volume,
+                revenue = offer_top_rollup.revenue + EXCLUDED.revenue,
+                margin = offer_top_rollup.margin + EXCLUDED.margin,
+                first_id = LEAST(offer_top_rollup.first_id, EXCLUDED.first_id)
+        """), {"u": username, "g": top_geo, "d": design, "n": sign, "p": sign * price, "m": sign * margin, "id": offer_id if sign > 0 else None})
+    if sign < 0:
+        if top_geo:
+            # L'offre retirée départageait peut-être cette clé : first_id repris sur les offres restantes
+            conn.execute(text(OFFERS_CTE + """
+                UPDATE offer_top_rollup SET first_id = (SELECT MIN(id) FROM t WHERE username = :u AND top_geo = :g AND top_design = :d)
+                WHERE username = :u AND geometry = :g AND design = :d AND first_id = :id
+            """), {"num_re": NUMERIC_RE, "u": username, "g": top_geo, "d": design, "id": offer_id})
+        conn.execute(text("DELETE FROM offer_stats_rollup WHERE username = :u AND volume <= 0"), {"u": username})
+        conn.execute(text("DELETE FROM offer_top_rollup WHERE username = :u AND volume <= 0"), {"u": username})
+
+def apply_offers_stats(conn, offers):
+    """Ajoute un lot d'offres [(id, username, tags, lens_details, financials)] aux cumuls : une requête par table.
+
+    Les parts sont additionnées en Python avant l'upsert (une ligne par clé, comme plusieurs apply_offer_stats).
+    """
+    stats, tops = {}, {}
+    for offer_id, username, tags, lens_details, financials in offers:
+        contrib = offer_contribution(tags, lens_details, financials)
+        if contrib is None: continue
+        values, price, margin, top_geo, design = contrib
+        username = username or ''
+        for c, v in [("*", "*")] + values:
+            acc = stats.setdefault((username, c, v), [0, 0.0])
+            acc[0] += 1; acc[1] += price
+        if top_geo:
+            acc = tops.setdefault((username, top_geo, design), [0, 0.0, 0.0, offer_id])
+            acc[0] += 1; acc[1] += price; acc[2] += margin; acc[3] = min(acc[3], offer_id)
+    if stats:
+        conn.execute(text("""
+            INSERT INTO offer_stats_rollup (username, category, value, volume, revenue) VALUES (:u, :c, :v, :n, :p)
+            ON CONFLICT (username, category, value) DO UPDATE SET
+                volume = offer_stats_rollup.volume + EXCLUDED.volume,
+                revenue = offer_stats_rollup.revenue + EXCLUDED.revenue
+        """), [{"u": u, "c": c, "v": v, "n": n, "p": p} for (u, c, v), (n, p) in sorted(stats.items())])
+    if tops:
+        conn.execute(text("""
+            INSERT INTO offer_top_rollup (username, geometry, design, volume, revenue, margin, first_id) VALUES (:u, :g, :d, :n, :p, :m, :id)
+            ON CONFLICT (username, geometry, design) DO UPDATE SET
+                volume = offer_top_rollup.volume + EXCLUDED.volume,
+                revenue = offer_top_rollup.revenue + EXCLUDED.revenue,
+                margin = offer_top_rollup.margin + EXCLUDED.margin,
+                first_id = LEAST(offer_top_rollup.first_id, EXCLUDED.first_id)
+        """), [{"u": u, "g": g, "d": d, "n": n, "p": p, "m": m, "id": i} for (u, g, d), (n, p, m, i) in sorted(tops.items())])
+
+# --- Lecture ---
+def read_offer_stats(conn, username):
+    """Réponse de /admin/stats construite à partir des cumuls ("all" = tous les adhérents)."""
+    where, params = ("", {}) if username == "all" else ("WHERE username = :u", {"u": username})
+    stats = {cat: {} for cat in STATS_CATEGORIES}
+    total_sales, total_revenue = 0, 0.0
+    res = conn.execute(text(f"SELECT category, value, SUM(volume) AS volume, SUM(revenue) AS revenue FROM offer_stats_rollup {where} GROUP BY category, value"), params)
+    for r in res:
+        if r.category == "*": total_sales, total_revenue = int(r.volume), float(r.revenue)
+        elif r.category in stats: stats[r.category][r.value] = {"volume": int(r.volume), "value": float(r.revenue)}
+    res = conn.execute(text(f"""
+        SELECT geometry, design, SUM(volume) AS volume, SUM(revenue) AS revenue, SUM(margin) AS margin, MIN(first_id) AS first_id
+        FROM offer_top_rollup {where} GROUP BY geometry, design
+    """), params)
+    top_data = {geo: [] for geo in TOP_GEOMETRIES}
+    for r in res:
+        if r.geometry in top_data: top_data[r.geometry].append((r.first_id or 0, {"name": r.design, "volume": int(r.volume), "value": float(r.revenue), "margin": float(r.margin)}))
+    final_tops = {}
+    for geo in TOP_GEOMETRIES:
+        items = [item for _, item in sorted(top_data[geo], key=lambda x: x[0])]
+        final_tops[geo] = {
+            "by_volume": sorted(items, key=lambda x: x['volume'], reverse=True)[:3],
+            "by_value": sorted(items, key=lambda x: x['value'], reverse=True)[:3],
+            "by_margin": sorted(items, key=lambda x: x['margin'], reverse=True)[:3]
+        }
+    return { "total_sales": total_sales, "total_revenue": total_revenue, "breakdown": stats, "tops": final_tops }
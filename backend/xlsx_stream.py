@@ -0,0 +1,195 @@
+"""Lecture en flux des classeurs .xlsx (catalogue, utilisateurs) sans objets cellule openpyxl.
+
+Le XML de chaque feuille est parcouru ligne par ligne dans le zip (mémoire constante) et rendu
+sous forme de tuples de valeurs, identiques à openpyxl load_workbook(read_only=True, data_only=True)
++ iter_rows(values_only=True) : mêmes lignes vides, même largeur, mêmes types (int/float/date/bool).
+"""
+import zipfile
+from contextlib import nullcontext
+import posixpath
+from xml.etree.ElementTree import iterparse
+from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format, is_timedelta_format
+from openpyxl.utils.datetime import from_excel, from_ISO8601, WINDOWS_EPOCH, MAC_EPOCH
+
+NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+REL_ID = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id"
+PKG_RELS = "{http://schemas.openxmlformats.org/package/2006/relationships}Relationship"
+ROW, CELL, VALUE, INLINE, TEXT, RUN = NS + "row", NS + "c", NS + "v", NS + "is", NS + "t", NS + "r"
+SHEET_DATA, DIMENSION, STRING_ITEM = NS + "sheetData", NS + "dimension", NS + "si"
+
+_DIGITS = "0123456789"
+_column_cache = {}
+
+def _column_index(letters):
+    col = _column_cache.get(letters)
+    if col is None:
+        col = 0
+        for ch in letters: col = col * 26 + ord(ch) - 64
+        _column_cache[letters] = col
+    return col
+
+def _split_ref(ref):
+    letters = ref.rstrip(_DIGITS)
+    return int(ref[len(letters):]), _column_index(letters)
+
+def _cast_number(value):
+    if "." in value or "E" in value or "e" in value: return float(value)
+    return int(value)
+
+def _text_content(node):
+    # Même règle qu'openpyxl (Text.content) : <t> direct + <t> des runs, sans la phonétique
+    plain = node.find(TEXT)
+    snippets = [plain.text or ""] if plain is not None else []
+    for run in node.iterfind(RUN):
+        t = run.find(TEXT)
+        if t is not None and t.text is not None: snippets.append(t.text)
+    return "".join(snippets)
+
+class XlsxReader:
+    """source : chemin ou fichier binaire seekable (UploadFile.file, BytesIO...)."""
+
+    def __init__(self, source):
+        self._zip = zipfile.ZipFile(source)
+        self._sheets, self.epoch, self._active = self._read_workbook()
+        self._strings = None
+        self._date_styles = self._timedelta_styles = None
+
+    def __enter__(self): return self
+    def __exit__(self, *exc): self.close()
+    def close(self): self._zip.close()
+
+    @property
+    def sheetnames(self): return list(self._sheets)
+
+    def sheet_size(self, sheet_name):
+        """Taille du XML de la feuille une fois décompressé (octets)."""
+        return self._zip.getinfo(self._sheets[sheet_name]).file_size
+
+    @property
+    def active(self):
+        """Nom de la feuille active (équivalent de wb.active.title)."""
+        names = self.sheetnames
+        return names[self._active] if 0 <= self._active < len(names) else names[0]
+
+    # --- Parties du classeur ---
+    def _read_workbook(self):
+        rels = {}
+        with self._zip.open("xl/_rels/workbook.xml.rels") as src:
+            for _, el in iterparse(src):
+                if el.tag == PKG_RELS: rels[el.get("Id")] = (el.get("Type", ""), self._part_path(el.get("Target")))
+        self._rels = rels
+        sheets, epoch, active = {}, WINDOWS_EPOCH, 0
+        with self._zip.open("xl/workbook.xml") as src:
+            for _, el in iterparse(src):
+                if el.tag == NS + "sheet": sheets[el.get("name")] = rels[el.get(REL_ID)][1]
+                elif el.tag == NS + "workbookPr" and el.get("date1904") in ("1", "true"): epoch = MAC_EPOCH
+                elif el.tag == NS + "workbookView" and el.get("activeTab"): active = int(el.get("activeTab"))
+        return sheets, epoch, active
+
+    def _part_path(self, target):
+        if target.startswith("/"): return target[1:]
+        return posixpath.normpath(posixpath.join("xl", target))
+
+    def _part(self, rel_type, default):
+        for kind, path in self._rels.values():
+            if kind.endswith(rel_type): return path
+        return default
+
+    def _shared_strings(self):
+        if self._strings is None:
+            strings, path = [], self._part("/sharedStrings", "xl/sharedStrings.xml")
+            if path in self._zip.NameToInfo:
+                with self._zip.open(path) as src:
+                    for _, el in iterparse(src):
+                        if el.tag == STRING_ITEM:
+                            strings.append(_text_content(el).replace('x005F_', ''))
+                            el.clear()
+            self._strings = strings
+        return self._strings
+
+    def _styles(self):
+        if self._date_styles is None:
+            custom, formats, path = {}, [], self._part("/styles", "xl/styles.xml")
+            if path in self._zip.NameToInfo:
+                with self._zip.open(path) as src:
+                    in_fmts = in_xfs = False
+                    for event, el in iterparse(src, ("start", "end")):
+                        if el.tag == NS + "numFmts": in_fmts = event == "start"
+                        elif el.tag == NS + "cellXfs": in_xfs = event == "start"
+                        elif event == "end" and in_fmts and el.tag == NS + "numFmt": custom[int(el.get("numFmtId"))] = el.get("formatCode")
+                        elif event == "end" and in_xfs and el.tag == NS + "xf": formats.append(int(el.get("numFmtId", 0)))
+            fmts = [custom[i] if i in custom else BUILTIN_FORMATS.get(i) for i in formats]
+            self._date_styles = {i for i, f in enumerate(fmts) if is_date_format(f)}
+            self._timedelta_styles = {i for i, f in enumerate(fmts) if is_timedelta_format(f)}
+        return self._date_styles
+
+    # --- Lignes ---
+    def _cells(self, row):
+        """[(colonne, valeur)] d'un élément <row>."""
+        strings, dates = self._strings, self._date_styles
+        cells, col = [], 0
+        for c in row:
+            if c.tag != CELL: continue
+            ref = c.get("r")
+            if ref: col = _column_index(ref.rstrip(_DIGITS))
+            else: col += 1
+            kind = c.get("t", "n")
+            if kind == "inlineStr":
+                node = c.find(INLINE)
+                cells.append((col, _text_content(node) if node is not None else None))
+                continue
+            value = c.findtext(VALUE) or None
+            if value is not None:
+                if kind == "n":
+                    value = _cast_number(value)
+                    style = c.get("s")
+                    if style and int(style) in dates:
+                        try: value = from_excel(value, self.epoch, timedelta=int(style) in self._timedelta_styles)
+                        except (OverflowError, ValueError): value = "#VALUE!"
+                elif kind == "s": value = strings[int(value)]
+                elif kind == "b": value = bool(int(value))
+                elif kind == "d": value = from_ISO8601(value)
+            cells.append((col, value))
+        return cells
+
+    def iter_rows(self, sheet_name):
+        """Tuples de valeurs ligne par ligne, comme openpyxl iter_rows(values_only=True) en lecture seule."""
+        self._shared_strings(); self._styles()
+        max_col = max_row = None
+        empty_row = []
+        counter, idx, row_counter = 1, 1, 0
+        with self._zip.open(self._sheets[sheet_name]) as src:
+            sheet_data = None
+            for event, el in iterparse(src, ("start", "end")):
+                if event == "start":
+                    if el.tag == SHEET_DATA: sheet_data = el
+                    continue
+                tag = el.tag
+                if tag == ROW:
+                    r = el.get("r")
+                    row_counter = int(float(r)) if r else row_counter + 1
+                    idx, cells = row_counter, self._cells(el)
+                    sheet_data.clear() # on ne garde rien des lignes déjà rendues
+                    if max_row is not None and idx > max_row: break
+                    for _ in range(counter, idx):
+                        counter += 1
+                        yield empty_row
+                    if counter <= idx:
+                        counter += 1
+                        if not cells and not max_col: yield (); continue
+                        width = max_col or cells[-1][0]
+                        values = [None] * width
+                        for col, value in cells:
+                            if 1 <= col <= width: values[col - 1] = value
+                        yield tuple(values)
+                elif tag == DIMENSION:
+                    end = el.get("ref", "").split(":")[-1].replace("$", "")
+                    if end.rstrip(_DIGITS) and end.rstrip(_DIGITS) != end:
+                        max_row, max_col = _split_ref(end)
+                        empty_row = (None,) * max_col
+        if max_row is not None and max_row < idx:
+            for _ in range(counter, max_row + 1): yield empty_row
+
+def open_workbook(source):
+    """XlsxReader sur source ; un XlsxReader déjà ouvert est réutilisé tel quel (et pas fermé)."""
+    return nullcontext(source) if isinstance(source, XlsxReader) else XlsxReader(source)
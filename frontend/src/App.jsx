@@ -62,6 +62,20 @@ const LENS_TYPES = [ { id: '', label: 'TOUS' }, { id: 'UNIFOCAL', label: 'UNIFOC
 
 const hexToRgb = (hex) => { if (!hex || typeof hex !== 'string') return "0 0 0"; const result = /^#?([a-f\d]{2})([a-f\d]{2})([a-f\d]{2})$/i.exec(hex); return result ? `${parseInt(result[1], 16)} ${parseInt(result[2], 16)} ${parseInt(result[3], 16)}` : "0 0 0"; };
 const cleanText = (text) => { if (text === null || text === undefined) return ""; return String(text).toUpperCase().trim(); };
+// Empreinte des exclusions catalogue (marques / designs / matières), comparée à celle enregistrée en base
+const exclusionsKey = (s) => JSON.stringify(['disabledBrands', 'disabledDesigns', 'disabledMaterials'].map(k => (Array.isArray(s?.[k]) ? s[k] : []).map(cleanText).sort()));
+// Catalogue au format colonnes (?format=columnar) -> liste de verres ; une liste classique passe telle quelle
+const decodeColumnar = (p) => {
+    if (Array.isArray(p)) return p;
+    if (!p || !Array.isArray(p.names)) return [];
+    const rows = new Array(p.count);
+    for (let i = 0; i < p.count; i++) {
+        const row = {};
+        p.names.forEach(n => { const col = p.columns[n]; row[n] = p.dicts[n] ? p.dicts[n][col[i]] : col[i]; });
+        rows[i] = row;
+    }
+    return rows;
+};
 const safeNum = (val) => { const num = parseFloat(val); return isNaN(num) ? 0 : num; };
 const safeJSONParse = (key, defaultValue) => { try { const item = localStorage.getItem(key); return item ? JSON.parse(item) : defaultValue; } catch { return defaultValue; } };
 const getLensKey = (l) => `${cleanText(l.type)}_${cleanText(l.design)}_${cleanText(l.index_mat)}_${cleanText(l.coating)}`;
@@ -783,7 +797,7 @@ function App() {
   const [syncLoading, setSyncLoading] = useState(false); const [syncStatus, setSyncStatus] = useState(null); const [sheetsUrl, setSheetsUrl] = useState(localStorage.getItem("optique_sheets_url") || "");
   const [stats, setStats] = useState({ total: 0, filtered: 0 });
   const [client, setClient] = useState({ name: '', firstname: '', dob: '', reimbursement: 0 }); const [secondPairPrice, setSecondPairPrice] = useState(0);
-  const [uploadFile, setUploadFile] = useState(null); const [uploadProgress, setUploadProgress] = useState(0);
+  const [uploadFile, setUploadFile] = useState(null); const [uploadProgress, setUploadProgress] = useState(0); const [importStatus, setImportStatus] = useState(''); const [diffImport, setDiffImport] = useState(false);
   const [userFile, setUserFile] = useState(null);
   const [showPricingConfig, setShowPricingConfig] = useState(false); // État pour la modale plein écran
   const [showHypervisor, setShowHypervisor] = useState(false); // AJOUT: État Hyperviseur
@@ -791,6 +805,7 @@ function App() {
   
   // NOUVEAUX ETATS POUR GESTION DESIGNS
   const [designModalGeometry, setDesignModalGeometry] = useState(null); // 'UNIFOCAL', 'PROGRESSIF', etc. ou null
+  const [savedExclusions, setSavedExclusions] = useState(() => sessionStorage.getItem("optique_saved_exclusions")); // exclusions connues du serveur
 
   // Gestion Persistance Logo et Thème
   const [userSettings, setUserSettings] = useState(() => {
@@ -850,6 +865,8 @@ function App() {
   };
   
   // AJOUT : Fonction de sauvegarde des paramètres vers le backend
+  const markExclusionsSaved = (s) => { const k = exclusionsKey(s); setSavedExclusions(k); sessionStorage.setItem("optique_saved_exclusions", k); };
+
   const saveSettingsToBackend = async () => {
       if (!user) return;
       try {
@@ -858,6 +875,7 @@ function App() {
               username: user.username,
               settings: userSettings
           });
+          markExclusionsSaved(userSettings);
           alert("✅ Préférences de filtres sauvegardées !");
       } catch (err) {
           console.error("Erreur sauvegarde settings", err);
@@ -913,7 +931,10 @@ function App() {
   const textClass = isDarkTheme ? "text-white" : "text-slate-800"; 
   const currentTheme = { primary: currentSettings.themeColor === 'custom' ? 'bg-[var(--theme-primary)]' : 'bg-blue-700' };
 
-  useEffect(() => { fetchData(); }, [formData.brand, formData.network, formData.type]); 
+  // Catalogue déjà filtré par le serveur (for_user) tant que les exclusions locales sont celles enregistrées ;
+  // le panneau Paramètres garde le catalogue complet pour pouvoir réactiver marques, designs et matières.
+  const catalogUser = user && !showSettings && savedExclusions === exclusionsKey(userSettings) ? user.username : undefined;
+  useEffect(() => { fetchData(); }, [formData.brand, formData.network, formData.type, catalogUser]); 
   useEffect(() => { sessionStorage.setItem("optique_client", JSON.stringify(client)); }, [client]);
   useEffect(() => { sessionStorage.setItem("optique_second_pair", secondPairPrice); }, [secondPairPrice]);
   useEffect(() => { sessionStorage.setItem("optique_form_data", JSON.stringify(formData)); }, [formData]);
@@ -1094,9 +1115,10 @@ function App() {
 
   const fetchData = () => {
     setLoading(true); setError(null); 
-    const params = { brand: formData.brand === '' ? undefined : formData.brand, pocketLimit: 0 };
+    const params = { brand: formData.brand === '' ? undefined : formData.brand, pocketLimit: 0, format: 'columnar' };
     if (formData.type) params.type = formData.type;
-    axios.get(API_URL, { params }).then(res => { setIsOnline(true); setLenses(Array.isArray(res.data) ? res.data : []); setLoading(false); }).catch(err => { console.warn("Mode Hors Ligne", err); setIsOnline(false); setLenses(DEMO_LENSES); setLoading(false); });
+    if (catalogUser) params.for_user = catalogUser;
+    axios.get(API_URL, { params }).then(res => { setIsOnline(true); setLenses(decodeColumnar(res.data)); setLoading(false); }).catch(err => { console.warn("Mode Hors Ligne", err); setIsOnline(false); setLenses(DEMO_LENSES); setLoading(false); });
   };
 
   const handleReset = () => {
@@ -1109,7 +1131,7 @@ function App() {
       }
   };
 
-  const handleLogin = (u) => { setUser(u); sessionStorage.setItem("optique_user", JSON.stringify(u)); 
+  const handleLogin = (u) => { setUser(u); sessionStorage.setItem("optique_user", JSON.stringify(u)); markExclusionsSaved(u.settings); 
       if (u.settings && Object.keys(u.settings).length > 0) {
           const mergedSettings = { ...DEFAULT_SETTINGS, ...u.settings, pricing: { ...DEFAULT_SETTINGS.pricing, ...(u.settings.pricing || {}) }, perLensConfig: { ...DEFAULT_SETTINGS.perLensConfig, ...(u.settings.perLensConfig || {}) } };
           setUserSettings(mergedSettings); localStorage.setItem("optique_user_settings", JSON.stringify(mergedSettings));
@@ -1138,12 +1160,25 @@ function App() {
       }
   }, [user]);
 
-  const fetchHistory = () => { 
-      const params = { username: user.username };
+  // Curseur de la page suivante (en-tête X-Next-Cursor), null quand tout l'historique est chargé
+  const [historyCursor, setHistoryCursor] = useState(null);
+
+  const fetchHistory = (cursor = null) => { 
+      const params = { username: user.username, fields: 'summary', identity: 'handle' };
       if (user.role === 'admin' && adminHistoryFilter) {
           params.target_user = adminHistoryFilter;
       }
-      axios.get(SAVE_URL, { params }).then(res => setSavedOffers(res.data)).catch(err => console.error("Erreur historique", err)); 
+      if (cursor) params.cursor = cursor;
+      axios.get(SAVE_URL, { params }).then(res => { setSavedOffers(prev => cursor ? [...prev, ...res.data] : res.data); setHistoryCursor(res.headers['x-next-cursor'] || null); fetchIdentities(res.data); }).catch(err => console.error("Erreur historique", err)); 
+  };
+
+  // Identités chiffrées : déchiffrées par lot, seulement pour les dossiers de la page chargée
+  const fetchIdentities = (offers) => {
+      const ids = offers.map(o => o.identity);
+      if (ids.length === 0) return;
+      axios.post(`${SAVE_URL}/identities`, { username: user.username, ids }).then(res => {
+          setSavedOffers(prev => prev.map(o => res.data[o.identity] ? { ...o, client: res.data[o.identity] } : o));
+      }).catch(err => console.error("Erreur identités", err));
   };
   
   // Refresh historique quand le filtre change
@@ -1193,7 +1228,9 @@ function App() {
   };
   
   const deleteOffer = (id) => { if (window.confirm("⚠️ Supprimer ce dossier ?")) { axios.delete(`${SAVE_URL}/${id}`).then(() => { alert("Dossier supprimé."); fetchHistory(); }).catch(err => alert("Erreur")); } };
-  const triggerFileUpload = () => { if (!uploadFile) return alert("Fichier manquant"); setSyncLoading(true); setUploadProgress(0); const data = new FormData(); data.append('file', uploadFile); axios.post(UPLOAD_URL, data, { onUploadProgress: (e) => { setUploadProgress(Math.round((e.loaded * 100) / e.total)); } }).then(res => { alert(`✅ ${res.data.count} verres importés.`); fetchData(); }).finally(() => setSyncLoading(false)); };
+  // L'import tourne en tâche de fond côté serveur : on suit sa progression jusqu'au succès / à l'erreur
+  const pollImportJob = (jobId) => { axios.get(`${UPLOAD_URL}/jobs/${jobId}`).then(res => { const job = res.data; if (job.status === 'success') { setImportStatus(''); setSyncLoading(false); const ch = job.changes; alert(ch ? `✅ ${job.count} verres lus : ${ch.inserted} ajoutés, ${ch.updated} modifiés, ${ch.deleted} supprimés, ${ch.unchanged} inchangés.` : `✅ ${job.count} verres importés.`); fetchData(); } else if (job.status === 'error') { setImportStatus(''); setSyncLoading(false); alert(`❌ ERREUR: ${job.error}`); } else { setImportStatus(`${job.phase === 'running' ? 'LECTURE' : job.phase === 'merging' ? 'COMPARAISON' : 'FINALISATION'} ${job.parsed}`); setTimeout(() => pollImportJob(jobId), 1000); } }).catch(err => { setImportStatus(''); setSyncLoading(false); alert(`❌ ERREUR: ${err.message}`); }); };
+  const triggerFileUpload = () => { if (!uploadFile) return alert("Fichier manquant"); setSyncLoading(true); setUploadProgress(0); setImportStatus(''); const data = new FormData(); data.append('file', uploadFile); axios.post(UPLOAD_URL, data, { params: { mode: diffImport ? 'diff' : 'replace' }, onUploadProgress: (e) => { setUploadProgress(Math.round((e.loaded * 100) / e.total)); } }).then(res => pollImportJob(res.data.job_id)).catch(err => { setSyncLoading(false); alert(`❌ ERREUR: ${err.response?.data?.detail || err.message}`); }); };
   const triggerUserUpload = () => { if (!userFile) return alert("Fichier manquant"); setSyncLoading(true); const data = new FormData(); data.append('file', userFile); axios.post(`${baseBackendUrl}/upload-users`, data).then(res => alert(`✅ ${res.data.count} utilisateurs.`)).finally(() => setSyncLoading(false)); };
   const handleChange = (e) => { const { name, value, type, checked } = e.target; setFormData(prev => ({ ...prev, [name]: type === 'checkbox' ? checked : value })); };
   const handleClientChange = (e) => { const { name, value } = e.target; if (name === 'reimbursement' && parseFloat(value) < 0) return; setClient(prev => ({ ...prev, [name]: value })); };
@@ -1473,8 +1510,9 @@ function App() {
                             <label className="block text-xs font-bold text-slate-600 mb-2">IMPORTER CATALOGUE VERRES</label>
                             <div className="flex gap-2">
                                 <input type="file" accept=".xlsx" onChange={(e) => setUploadFile(e.target.files[0])} className="flex-1 text-xs bg-white"/>
-                                <button onClick={triggerFileUpload} disabled={syncLoading} className="bg-orange-600 text-white px-4 py-2 rounded text-xs font-bold">{syncLoading ? "..." : "ENVOYER"}</button>
+                                <button onClick={triggerFileUpload} disabled={syncLoading} className="bg-orange-600 text-white px-4 py-2 rounded text-xs font-bold">{syncLoading ? (importStatus || "...") : "ENVOYER"}</button>
                             </div>
+                            <label className="flex items-center gap-2 mt-2 text-xs text-slate-600"><input type="checkbox" checked={diffImport} onChange={(e) => setDiffImport(e.target.checked)}/>Mise à jour différentielle (seuls les verres modifiés sont réécrits)</label>
                         </div>
                         <div className="flex justify-between items-center"><span className="text-xs">État Base de Données</span><button onClick={checkDatabase} className="bg-white border border-orange-300 px-3 py-1 rounded text-xs font-bold text-orange-700">VÉRIFIER</button></div>
                     </div>
@@ -1658,8 +1696,8 @@ function App() {
                                 <div className="flex items-center gap-4">
                                     <div className="bg-blue-100 p-3 rounded-full text-blue-600"><User className="w-5 h-5"/></div>
                                     <div>
-                                        <div className="font-bold text-lg">{offer.client.name || "Donnée Illisible"} {offer.client.firstname}</div>
-                                        <div className="text-xs text-slate-500 font-mono flex items-center gap-2"><Calendar className="w-3 h-3"/> NÉ(E) LE {offer.client.dob || "?"} • {offer.date}</div>
+                                        <div className="font-bold text-lg">{offer.client ? `${offer.client.name || "Donnée Illisible"} ${offer.client.firstname || ""}` : "…"}</div>
+                                        <div className="text-xs text-slate-500 font-mono flex items-center gap-2"><Calendar className="w-3 h-3"/> NÉ(E) LE {offer.client?.dob || "?"} • {offer.date}</div>
                                         {user.role === 'admin' && offer.owner && <div className="text-[10px] bg-purple-100 text-purple-700 px-2 py-0.5 rounded mt-1 inline-block font-bold">PAR: {offer.owner}</div>}
                                     </div>
                                 </div>
@@ -1676,6 +1714,9 @@ function App() {
                         ))
                     )}
                 </div>
+                {historyCursor && (
+                    <button onClick={() => fetchHistory(historyCursor)} className="w-full mt-4 py-3 bg-slate-100 hover:bg-slate-200 rounded-xl font-bold text-slate-600 transition-colors">CHARGER LES DOSSIERS PLUS ANCIENS</button>
+                )}
             </div>
           </div>
       )}